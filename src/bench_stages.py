@@ -0,0 +1,304 @@
+import pandas as pd
+import numpy as np
+import os.path
+import sys
+import shutil
+import argparse
+import configparser
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from lib.ntlogging import logging, start_log_queue, stop_log_queue
+from lib.stox_utils import *
+from lib.clean_prices import clean_prices
+from lib.filter_prices import filter_prices
+from lib.buy_sell_v3 import buy_sell_v3
+from lib.analyze import analyze
+from lib.buy_sell_matrix import buy_sell_matrix
+from lib.make_blacklist import make_blacklist
+from lib.pipeline import hold_budget_files, blacklist_files, analysis_outputs
+from lib.synthetic import write_synthetic
+from lib.metrics import path_rows, reset_peak_rss, peak_rss_mb
+
+
+# Scaling benchmarks for the pipeline stages.
+#
+#   python bench_stages.py --sizes 100,1000,7000 --holds 4,30
+#
+# For each universe size the first <size> symbols of the raw prices (or
+# with --synthetic, of synthetic prices made for the biggest size) are
+# copied to a scratch tree (BENCH_DATA_DIR/work/<size>/) and the stages run
+# there in order: clean, filter, then buy-sell and analyze for each hold,
+# then the buy-sell + analyze matrix over the holds and the blacklist.
+# The data paths are relative to the working dir (../data/...), so each
+# stage runs with the scratch src/ as its working dir, in a fresh process
+# so its peak resident memory can be measured.
+#
+# Each stage's time, rows in / out, rows per second (in) and peak memory
+# are appended to BENCH_HISTORY_FILE and compared with BENCH_BASELINE_FILE.
+# A stage slower or bigger than its baseline by more than the tolerance is
+# flagged and the exit status is 1.  --save-baseline stores the run as the
+# new baseline.
+
+BENCH_HISTORY_FILE = BENCH_DATA_DIR + "bench_history.csv"
+BENCH_BASELINE_FILE = BENCH_DATA_DIR + "bench_baseline.csv"
+STAGE_FUNCS = {'clean': clean_prices, 'filter': filter_prices,
+               'buysell': buy_sell_v3, 'analyze': analyze,
+               'matrix': buy_sell_matrix, 'blacklist': make_blacklist}
+STAGES = list(STAGE_FUNCS)
+
+HISTORY_COLS = ['run', 'stage', 'symbols', 'hold', 'rows_in', 'rows_out',
+                'seconds', 'rows_per_sec', 'peak_mb']
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(description="Pipeline scaling benchmarks")
+    parser.add_argument('--sizes', default="100,1000,7000",
+                        help="universe sizes (symbols)")
+    parser.add_argument('--holds', default="4,30", help="hold times (days)")
+    parser.add_argument('--stages', default=",".join(STAGES),
+                        help="stages to time")
+    parser.add_argument('--prices', default=RAW_PRICES_INPUT_FILE,
+                        help="raw prices to take the universes from")
+    parser.add_argument('--synthetic', action='store_true',
+                        help="use synthetic prices (lib/synthetic.py)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="synthetic prices seed")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slowdown / growth over the baseline")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store this run as the baseline")
+    parser.add_argument('--keep-work', action='store_true',
+                        help="keep the scratch data")
+
+    return parser.parse_args()
+
+
+def main():
+
+    args = parse_args()
+    start_log_queue()
+    sizes = [int(s) for s in args.sizes.split(",")]
+    holds = [int(h) for h in args.holds.split(",")]
+    stages = [s.strip() for s in args.stages.split(",")]
+    for stage in stages:
+        if stage not in STAGES:
+            logging.critical(f"Unknown stage {stage}, use: {STAGES}")
+            sys.exit(2)
+
+    # stage settings from stox.ini (one worker, so the peak is the stage's)
+    cfg = dict(load_config()['stox'])
+    cfg.update({'workers': '1', 'export_csv': 'no', 'incremental_clean': 'no',
+                'hold_times_list': args.holds, 'write_trade_log': 'yes'})
+
+    bench_dir = os.path.abspath(BENCH_DATA_DIR)
+    prices_file = os.path.abspath(args.prices)
+    os.makedirs(bench_dir, exist_ok=True)
+    if args.synthetic:
+        prices_file = synthetic_prices(max(sizes), args.seed)
+
+    run_id = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    results = []
+    for size in sizes:
+
+        work_dir = os.path.join(bench_dir, "work", str(size))
+        numsyms = make_universe(prices_file, size, work_dir)
+        src_dir = os.path.join(work_dir, "src")
+
+        for stage, hold, timed in stage_runs(stages, holds):
+            run_cfg = dict(cfg, stock_hold_time=str(hold or holds[0]))
+            seconds, rows_in, rows_out, peak_mb = run_stage_process(
+                stage, src_dir, run_cfg)
+            if not timed:
+                continue
+
+            results.append([run_id, stage, numsyms, hold, rows_in, rows_out,
+                            seconds, rows_in / max(seconds, 1e-9), peak_mb])
+            logging.info(f"{stage:10} {numsyms:6} symbols  hold {hold or '-':>3}" +
+                         f"  {seconds:9.2f} s  {results[-1][7]:12,.0f} rows/s" +
+                         f"  {peak_mb:9.1f} MB")
+
+        if not args.keep_work:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    run_df = pd.DataFrame(results, columns=HISTORY_COLS)
+    write_history(run_df)
+    regressions = check_baseline(run_df, args.tolerance)
+
+    if args.save_baseline:
+        run_df.to_csv(BENCH_BASELINE_FILE, index=False, float_format='%.3f')
+        logging.info(f"Saved baseline {BENCH_BASELINE_FILE}")
+
+    return 1 if regressions > 0 else 0
+
+
+# (stage, hold, timed) in run order, hold is 0 for stages that don't use
+# one.  Each stage needs the outputs of the ones before it, so the runs go
+# up to the last of the given stages and only those are timed.
+def stage_runs(stages, holds):
+
+    runs = [(s, 0) for s in ['clean', 'filter']]
+    for hold in holds:
+        runs += [(s, hold) for s in ['buysell', 'analyze']]
+    runs += [(s, 0) for s in ['matrix', 'blacklist']]
+
+    last = max(i for i, (s, h) in enumerate(runs) if s in stages)
+
+    return [(s, h, s in stages) for s, h in runs[:last + 1]]
+
+
+# Synthetic prices for num_symbols (kept in BENCH_DATA_DIR/raw/ and made
+# again only if the size or seed changes).  Returns the prices file.
+def synthetic_prices(num_symbols, seed):
+
+    raw_dir = os.path.abspath(BENCH_DATA_DIR + "raw/")
+    prices_file = os.path.join(raw_dir, os.path.basename(RAW_PRICES_INPUT_FILE))
+    params_file = os.path.join(raw_dir, "synthetic.txt")
+    params = f"symbols={num_symbols} seed={seed}"
+
+    if os.path.exists(params_file) and os.path.exists(prices_file):
+        with open(params_file) as f:
+            if f.read().strip() == params:
+                logging.info(f"Using synthetic prices {prices_file} ({params})")
+                return prices_file
+
+    write_synthetic(raw_dir, num_symbols, "1998-01-02", "2019-08-09", seed=seed)
+    with open(params_file, 'w') as f:
+        f.write(params + "\n")
+
+    return prices_file
+
+
+# Scratch tree with the first size symbols of the prices file and the
+# benchmark files.  Returns the number of symbols.
+def make_universe(prices_file, size, work_dir):
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+    raw_dir = os.path.join(work_dir, "data", "raw")
+    for d in [raw_dir, os.path.join(work_dir, "data", "stox"),
+              os.path.join(work_dir, "src")]:
+        os.makedirs(d)
+
+    # first size symbols in file order
+    symbols = []
+    seen = set()
+    for chunk_df in pd.read_csv(prices_file, usecols=['symbol'],
+                                chunksize=1000000, keep_default_na=False):
+        for sym in chunk_df['symbol'].unique():
+            if sym not in seen and len(symbols) < size:
+                seen.add(sym)
+                symbols.append(sym)
+        if len(symbols) >= size:
+            break
+
+    if len(symbols) < size:
+        logging.warning(f"{prices_file} has only {len(symbols)} symbols")
+
+    logging.info(f"Writing {len(symbols)} symbols to {raw_dir}")
+    out_file = os.path.join(raw_dir, os.path.basename(RAW_PRICES_INPUT_FILE))
+    write_header = True
+    for chunk_df in pd.read_csv(prices_file, chunksize=1000000,
+                                keep_default_na=False, dtype={'symbol': str}):
+        chunk_df = chunk_df[chunk_df['symbol'].isin(seen)]
+        with open(out_file, 'a') as f:
+            chunk_df.to_csv(f, index=False, header=write_header)
+        write_header = False
+
+    # the filter step reads the symbols from the symbols file
+    pd.DataFrame({'symbol': symbols}).to_csv(
+        os.path.join(work_dir, "data", "stox", os.path.basename(SYMBOLS_FILE)),
+        index=False)
+
+    for bench_file in get_benchmark_files(load_config()['stox']):
+        if os.path.exists(bench_file):
+            shutil.copy(bench_file, raw_dir)
+
+    return len(symbols)
+
+
+# Run a stage in a new process.  Returns (seconds, rows in, rows out,
+# peak MB).
+def run_stage_process(stage, src_dir, run_cfg):
+
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(time_stage, stage, src_dir, run_cfg).result()
+
+
+def time_stage(stage, src_dir, run_cfg):
+
+    os.chdir(src_dir)
+
+    config = configparser.ConfigParser()
+    config['stox'] = run_cfg
+    cfg = config['stox']
+
+    rows_in = stage_rows(stage, cfg, inputs=True)
+    start_log_queue()  # log as the menu does
+    # a spawned child starts with the driver's ru_maxrss, so the peak is
+    # read from VmHWM after resetting it
+    reset_peak_rss()
+    start = datetime.now()
+    STAGE_FUNCS[stage](cfg)
+    seconds = (datetime.now() - start).total_seconds()
+    stop_log_queue()
+    peak_mb = peak_rss_mb()
+    rows_out = stage_rows(stage, cfg, inputs=False)
+
+    return seconds, rows_in, rows_out, peak_mb
+
+
+# Rows read (inputs=True) or written by a stage.  The matrix reads the
+# filtered prices once for all its holds.
+def stage_rows(stage, cfg, inputs):
+
+    analysis_files = hold_budget_files(cfg, ANALYSIS_FILE_PREFIX)
+    files = {
+        'clean': ([RAW_PRICES_INPUT_FILE], [CLEANED_PRICES_STORE]),
+        'filter': ([CLEANED_PRICES_STORE], [FILTERED_PRICES_STORE]),
+        'buysell': ([FILTERED_PRICES_STORE], [BUY_SELL_RESULTS_FILE]),
+        'analyze': ([BUY_SELL_RESULTS_FILE], analysis_outputs(cfg)),
+        'matrix': ([FILTERED_PRICES_STORE], analysis_files),
+        'blacklist': (analysis_files,
+                      blacklist_files(cfg, BLACKLIST_FILE_PREFIX))}
+
+    return sum(path_rows(path) for path in files[stage][0 if inputs else 1])
+
+
+def write_history(run_df):
+
+    write_header = not os.path.exists(BENCH_HISTORY_FILE)
+    with open(BENCH_HISTORY_FILE, 'a') as f:
+        run_df.to_csv(f, index=False, header=write_header, float_format='%.3f')
+    logging.info(f"Appended {len(run_df)} results to {BENCH_HISTORY_FILE}")
+
+
+# Flag stages slower or bigger than the baseline.  Returns the count.
+def check_baseline(run_df, tolerance):
+
+    if not os.path.exists(BENCH_BASELINE_FILE):
+        logging.info("No baseline to compare with (use --save-baseline)")
+        return 0
+
+    base_df = pd.read_csv(BENCH_BASELINE_FILE)
+    keys = ['stage', 'symbols', 'hold']
+    cmp_df = run_df.merge(base_df[keys + ['seconds', 'peak_mb']], on=keys,
+                          suffixes=('', '_base'))
+
+    slow = cmp_df['seconds'] > cmp_df['seconds_base'] * (1.0 + tolerance)
+    big = cmp_df['peak_mb'] > cmp_df['peak_mb_base'] * (1.0 + tolerance)
+    for row in cmp_df[slow | big].itertuples():
+        logging.warning(f"REGRESSION {row.stage} {row.symbols} symbols " +
+                        f"hold {row.hold}: {row.seconds:.2f} s " +
+                        f"(baseline {row.seconds_base:.2f} s), " +
+                        f"{row.peak_mb:.1f} MB (baseline {row.peak_mb_base:.1f} MB)")
+
+    logging.info(f"{len(cmp_df)} stages compared with {BENCH_BASELINE_FILE}, " +
+                 f"{(slow | big).sum()} regressions")
+
+    return int((slow | big).sum())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,18 +6,42 @@ from math import floor
 from datetime import datetime, timedelta
 from lib.ntlogging import logging
 from lib.stox_utils import *
+from lib.parallel import get_workers, symbol_shards, map_shards
+from lib.trading_calendar import day_strings
 
 
-# Build the stats row for each symbol in the buy_sell_results
+# columns of the analysis files
+ANALYSIS_COLS = ['symbol', 
+                 'num_trades', 
+                 'pct_black', 
+                 'num_black', 
+                 'num_red',
+                 'avg_return', 
+                 'avg_gain', 
+                 'avg_loss',
+                 'max_gain', 
+                 'mg_buy_date', 
+                 'mg_buy_price',
+                 'mg_sell_date', 
+                 'mg_sell_price',
+                 'max_loss',
+                 'ml_buy_date',
+                 'ml_buy_price',
+                 'ml_sell_date',
+                 'ml_sell_price']
 
-def analyze(cfg):
+DATE_COLS = ['mg_buy_date', 'mg_sell_date', 'ml_buy_date', 'ml_sell_date']
 
-    hold_str = str(int(float(cfg['stock_hold_time'])))
-    budget_dollars_str = str(int(float(cfg['budget_dollars'])))
+# extra columns when the buy-sell results have the benchmark excess return
+EXCESS_COLS = ['avg_excess_return', 'pct_beat_bench']
 
-    analysis_postfix = hold_str + "_days_" + budget_dollars_str + "_dollars.csv"
 
-    analysis_output_file = ANALYSIS_FILE_PREFIX + analysis_postfix
+# Build the stats row for each symbol in the buy_sell_results
+
+def analyze(cfg):
+
+    analysis_output_file = (ANALYSIS_FILE_PREFIX + 
+        analysis_postfix(cfg['stock_hold_time'], cfg['budget_dollars']))
 
     # clean up the existing output file (ignore !exists error)
     try:
@@ -25,125 +49,212 @@ def analyze(cfg):
     except OSError:
         pass   
 
-    # load buy-sell results and group by symbol
+    workers = get_workers(cfg)
+    min_trades = int(cfg['analyze_min_trades'])
+
+    # load buy-sell results
     try:
         logging.info(f"Reading {BUY_SELL_RESULTS_FILE}")
-        bsr_df = pd.read_table(BUY_SELL_RESULTS_FILE, sep=",")
+        bsr_df = pd.read_table(BUY_SELL_RESULTS_FILE, sep=",",
+                               dtype={'symbol': 'category'})
         #bsr_df['buy_date'] = pd.to_datetime(bsr_df['buy_date'])
         #bsr_df['sell_date'] = pd.to_datetime(bsr_df['sell_date'])
-        bsr_df = bsr_df.groupby('symbol')
-        logging.info("Found " + str(len(bsr_df)) + " symbols in buy-sell data.")
     
     except Exception as e:
         logging.warning("Not parsed: " + BUY_SELL_RESULTS_FILE + "\n" + str(e))
         sys.exit()
 
-    results_lst = []  # output rows
-    qmax = 100000   # output queue max
-    write_header = True  # results file header (write once flag)
-    symnum = 0
-    numsyms = len(bsr_df)
-    
-    for symbol, sym_df in bsr_df:
-
-        try:
-
-            num_trades = len(sym_df)
-            blk_trades_df = sym_df[sym_df['gain_total'] > 0.0]
-            red_trades_df = sym_df[sym_df['gain_total'] < 0.0]
-            num_black = len(blk_trades_df)
-            pct_black = float(num_black) / float(num_trades)
-            num_red = len(red_trades_df)
-
-            avg_return = sym_df["gain_total"].mean()
-            avg_gain = blk_trades_df["gain_total"].mean()
-            avg_loss = red_trades_df["gain_total"].mean()
-
-            max_gain = blk_trades_df["gain_total"].max()
-            mg_idx = blk_trades_df['gain_total'].idxmax()
-            mg_buy_date = blk_trades_df.loc[mg_idx, 'buy_date']
-            mg_buy_price = blk_trades_df.loc[mg_idx, 'buy_price']
-            mg_sell_date = blk_trades_df.loc[mg_idx, 'sell_date']
-            mg_sell_price = blk_trades_df.loc[mg_idx, 'sell_price']
-            
-            
-            max_loss = red_trades_df["gain_total"].min()
-            ml_idx = red_trades_df['gain_total'].idxmin()
-            ml_buy_date = red_trades_df.loc[ml_idx, 'buy_date']
-            ml_buy_price = red_trades_df.loc[ml_idx, 'buy_price']
-            ml_sell_date = red_trades_df.loc[ml_idx, 'sell_date']
-            ml_sell_price = red_trades_df.loc[ml_idx, 'sell_price']
-
-            row = [ symbol, 
-                    num_trades, 
-                    pct_black, 
-                    num_black, 
-                    num_red, 
-                    avg_return,
-                    avg_gain, 
-                    avg_loss, 
-                    max_gain, 
-                    mg_buy_date, 
-                    mg_buy_price,
-                    mg_sell_date, 
-                    mg_sell_price, 
-                    max_loss, 
-                    ml_buy_date,
-                    ml_buy_price, 
-                    ml_sell_date, 
-                    ml_sell_price]
-
-            # drop low numbers of trades
-            if num_trades >= int(cfg['analyze_min_trades']):
-                results_lst.append(row)
-            else:
-                logging.info(f"dropped symbol {symbol} for low trade occurrences.")
-
-            # peridocially write the results list
-            if len(results_lst) >= qmax:
-                logging.info(f"Writing {qmax} results to {analysis_output_file}")
-                append_analysis_csv(analysis_output_file, results_lst, write_header)
-                write_header = False
-                results_lst = []
-
-            symnum += 1    # keep track of how many symbols have been processed
-            logging.info(f"{symbol} \t\t[{symnum} of {numsyms}] \tpct_black: " +
-                        f"{pct_black:.1f} avg_return: {avg_return:.2f} ")    
-
-        except Exception as e:
-            logging.error("Exception in analyze " + str(e))
-
-    # final csv update
-    if len(results_lst) > 0:
-        logging.info(f"Writing {len(results_lst)} results to {analysis_output_file}")
-        append_analysis_csv(analysis_output_file, results_lst, write_header)
-
-
-def append_analysis_csv(csv_file, results_lst, write_header):
-
-    # columns for output dataframe
-    cols = ['symbol', 
-            'num_trades', 
-            'pct_black', 
-            'num_black', 
-            'num_red',
-            'avg_return', 
-            'avg_gain', 
-            'avg_loss',
-            'max_gain', 
-            'mg_buy_date', 
-            'mg_buy_price',
-            'mg_sell_date', 
-            'mg_sell_price',
-            'max_loss',
-            'ml_buy_date',
-            'ml_buy_price',
-            'ml_sell_date',
-            'ml_sell_price']
-
-
-    out_df = pd.DataFrame(results_lst, columns=cols).sort_values('pct_black',
-                          ascending=False)
+    # analyze shards of whole symbols
+    if not bsr_df['symbol'].is_monotonic_increasing:
+        bsr_df = bsr_df.sort_values('symbol', kind='stable')
+
+    shards = symbol_shards(bsr_df, workers)
+    frames = list(map_shards(analyze_trades, shards, workers, min_trades))
+    results_df = pd.concat(frames) if frames else pd.DataFrame(columns=ANALYSIS_COLS)
+
+    # csv update
+    if len(results_df) > 0:
+        logging.info(f"Writing {len(results_df)} results to {analysis_output_file}")
+        append_analysis_csv(analysis_output_file, results_df, True)
+
+
+# analysis_<hold>_days_<budget>_dollars.csv naming
+def analysis_postfix(hold, budget):
+
+    hold_str = str(int(float(hold)))
+    budget_dollars_str = str(int(float(budget)))
+
+    return hold_str + "_days_" + budget_dollars_str + "_dollars.csv"
+
+
+# Build the stats rows for a frame of buy-sell results.  A symbol with no
+# black (or red) trades gets NaN for its avg/max gain (or loss) and the
+# trade fields with it.  Results with the excess_return column (buy-sell
+# with benchmark_excess on) also get the EXCESS_COLS.
+def analyze_trades(bsr_df, min_trades):
+
+    stats = TradeStats()
+    stats.update(bsr_df)
+    logging.info("Found " + str(len(stats)) + " symbols in buy-sell data.")
+
+    return stats.rows(min_trades)
+
+
+# Online per-symbol trade statistics.  Batches of trades (buy-sell results
+# rows, in any symbol order) are folded in with update(): counts and sums
+# add, and the max gain / max loss trades are replaced only by a strictly
+# larger one, so the first such trade is kept.  rows() gives the analysis
+# rows without the trades ever being written out.
+class TradeStats:
+
+    SUM_COLS = ['num_trades', 'num_black', 'num_red', 
+                'sum_return', 'sum_gain', 'sum_loss']
+    MG_COLS = ['max_gain', 'mg_buy_date', 'mg_buy_price', 
+               'mg_sell_date', 'mg_sell_price']
+    ML_COLS = ['max_loss', 'ml_buy_date', 'ml_buy_price', 
+               'ml_sell_date', 'ml_sell_price']
+    EXCESS_SUM_COLS = ['num_excess', 'num_beat', 'sum_excess']
+
+    def __init__(self):
+        self.stats_df = None
+
+    def __len__(self):
+        return 0 if self.stats_df is None else len(self.stats_df)
+
+    # fold in a batch of trades, returns the batch's own per-symbol stats
+    def update(self, bsr_df):
+
+        batch_df = batch_stats(bsr_df)
+        if self.stats_df is None:
+            self.stats_df = batch_df
+            return batch_df
+
+        # symbols not seen before (e.g. the next shard)
+        old_df = self.stats_df
+        seen = batch_df.index.isin(old_df.index)
+        if not seen.any():
+            self.stats_df = pd.concat([old_df, batch_df])
+            return batch_df
+
+        old_df = old_df.reindex(old_df.index.union(batch_df.index))
+        new_df = batch_df.reindex(old_df.index)
+
+        sum_cols = self.SUM_COLS + [c for c in self.EXCESS_SUM_COLS 
+                                    if c in old_df]
+        sums = old_df[sum_cols].fillna(0) + new_df[sum_cols].fillna(0)
+        old_df[sum_cols] = sums
+
+        larger = (new_df['max_gain'] > old_df['max_gain']) | (
+                  old_df['max_gain'].isna() & new_df['max_gain'].notna())
+        old_df.loc[larger, self.MG_COLS] = new_df.loc[larger, self.MG_COLS]
+
+        smaller = (new_df['max_loss'] < old_df['max_loss']) | (
+                   old_df['max_loss'].isna() & new_df['max_loss'].notna())
+        old_df.loc[smaller, self.ML_COLS] = new_df.loc[smaller, self.ML_COLS]
+
+        self.stats_df = old_df
+
+        return batch_df
+
+    # analysis rows (in symbol order) of the symbols with min_trades or more
+    def rows(self, min_trades):
+
+        if self.stats_df is None:
+            return pd.DataFrame(columns=ANALYSIS_COLS)
+
+        stats_df = self.stats_df.sort_index()
+        counts = stats_df[['num_trades', 'num_black', 'num_red']].astype(np.int64)
+        stats_df[['num_trades', 'num_black', 'num_red']] = counts
+
+        stats_df['pct_black'] = stats_df['num_black'] / stats_df['num_trades']
+        stats_df['avg_return'] = stats_df['sum_return'] / stats_df['num_trades']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats_df['avg_gain'] = stats_df['sum_gain'] / stats_df['num_black']
+            stats_df['avg_loss'] = stats_df['sum_loss'] / stats_df['num_red']
+
+        # drop low numbers of trades
+        dropped = stats_df.index[stats_df['num_trades'] < min_trades]
+        if len(dropped) > 0:
+            logging.info(f"dropped {len(dropped)} symbols for low trade " +
+                         f"occurrences: {list(dropped)}")
+
+        stats_df = stats_df[stats_df['num_trades'] >= min_trades]
+
+        out_cols = ANALYSIS_COLS
+        if 'sum_excess' in stats_df:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats_df['avg_excess_return'] = (stats_df['sum_excess'] / 
+                                                 stats_df['num_excess'])
+                stats_df['pct_beat_bench'] = (stats_df['num_beat'] / 
+                                              stats_df['num_excess'])
+            out_cols = ANALYSIS_COLS + EXCESS_COLS
+
+        return stats_df.rename_axis('symbol').reset_index()[out_cols]
+
+
+# Counts, sums and extreme trades of a batch of trades, indexed by symbol
+def batch_stats(bsr_df):
+
+    gains = bsr_df['gain_total']
+    trades_df = pd.DataFrame({'symbol': bsr_df['symbol'],
+                              'gain': gains,
+                              'black': gains.where(gains > 0.0),
+                              'red': gains.where(gains < 0.0)})
+
+    # observed: only the symbols in the batch, not every category
+    stats_df = trades_df.groupby('symbol', observed=True).agg(
+        num_trades=('gain', 'size'),
+        num_black=('black', 'count'),
+        num_red=('red', 'count'),
+        sum_return=('gain', 'sum'),
+        sum_gain=('black', 'sum'),
+        sum_loss=('red', 'sum'),
+        max_gain=('black', 'max'),
+        max_loss=('red', 'min'))
+
+    # trades with a benchmark return (excess_return is NaN without one)
+    if 'excess_return' in bsr_df:
+        excess = bsr_df['excess_return']
+        excess_df = pd.DataFrame({'symbol': bsr_df['symbol'],
+                                  'excess': excess,
+                                  'beat': (excess > 0.0).astype(float).where(excess.notna())})
+        excess_df = excess_df.groupby('symbol', observed=True).agg(
+            num_excess=('excess', 'count'),
+            num_beat=('beat', 'sum'),
+            sum_excess=('excess', 'sum'))
+        stats_df = stats_df.join(excess_df)
+
+    # the first trade with the max gain / max loss of each symbol
+    mg_df = extreme_trades(bsr_df, trades_df['black'], 'max', 'mg_')
+    ml_df = extreme_trades(bsr_df, trades_df['red'], 'min', 'ml_')
+
+    return stats_df.join(mg_df).join(ml_df)
+
+
+# Buy/sell date and price of the first trade per symbol whose value equals
+# the symbol's max (or min).  Symbols with no values are absent.
+def extreme_trades(bsr_df, values, how, prefix):
+
+    extreme = values.groupby(bsr_df['symbol'], observed=True).transform(how)
+    trade_cols = ['buy_date', 'buy_price', 'sell_date', 'sell_price']
+    ext_df = bsr_df.loc[values == extreme, ['symbol'] + trade_cols]
+    ext_df = ext_df.groupby('symbol', observed=True).head(1).set_index('symbol')
+
+    return ext_df.add_prefix(prefix)
+
+
+# Write the stats rows, ordered by pct_black over all symbols (ties by
+# symbol)
+def append_analysis_csv(csv_file, results_df, write_header):
+
+    out_df = results_df.sort_values(['pct_black', 'symbol'], 
+                                    ascending=[False, True], kind='stable')
+
+    # day ordinals from the simulation (dates read from a results file
+    # are already strings)
+    for col in DATE_COLS:
+        if col in out_df and pd.api.types.is_numeric_dtype(out_df[col]):
+            out_df[col] = day_strings(out_df[col].to_numpy(dtype=float))
 
     with open(csv_file, 'a') as f:
         out_df.to_csv(f, index=False, sep=",", float_format='%.3f', 
@@ -0,0 +1,102 @@
+import time
+import queue
+import threading
+from lib.ntlogging import logging
+
+
+# Background writer for results output
+#
+# Writes (e.g. append_csv of a shard's trades) are put on a bounded queue
+# and run in order by a background thread, so the simulation goes on with
+# the next shard while the last one is formatted and written.  The queue
+# holds at most max_pending writes (double buffered: one being written,
+# one waiting); submit() blocks while it is full, so a simulation faster
+# than the disk waits rather than piling up results in memory.  With
+# workers the shards are also submitted a few at a time (bounded_map in
+# lib/parallel.py), so the wait holds back the workers too.
+#
+# close() (or leaving the with block) runs every queued write before it
+# returns.  A failed write stops the writes after it and its exception is
+# raised in the caller by the next submit(), flush() or close().
+#
+#   with BackgroundWriter() as writer:
+#       writer.submit(append_csv, csv_file, out_df, write_header)
+
+MAX_PENDING = 2  # writes waiting on the queue
+
+
+class BackgroundWriter:
+
+    def __init__(self, max_pending=MAX_PENDING):
+
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.wait_seconds = 0.0  # time submit() waited on a full queue
+        self.thread = threading.Thread(target=self.run, name="results-writer",
+                                       daemon=True)
+        self.thread.start()
+
+    # Queue func(*args), the args must not be changed after this
+    def submit(self, func, *args):
+
+        self.raise_error()
+        if self.thread is None:
+            raise ValueError("Background writer is closed")
+
+        start = time.perf_counter()
+        self.jobs.put((func, args))
+        self.wait_seconds += time.perf_counter() - start
+
+    # Wait for the queued writes
+    def flush(self):
+
+        self.jobs.join()
+        self.raise_error()
+
+    # Run the queued writes and stop the thread
+    def close(self):
+
+        if self.thread is None:
+            return
+
+        self.jobs.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.wait_seconds >= 0.1:
+            logging.info(f"Waited {self.wait_seconds:.1f} s on results writes")
+        self.raise_error()
+
+    def run(self):
+
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    func, args = job
+                    func(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def raise_error(self):
+
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    # the writes are finished either way, a write error is raised only if
+    # the block didn't raise one of its own
+    def __exit__(self, exc_type, exc, tb):
+
+        try:
+            self.close()
+        except Exception:
+            if exc_type is None:
+                raise
+
+        return False
@@ -0,0 +1,132 @@
+import pandas as pd 
+import numpy as np
+import os.path
+import sys
+from lib.ntlogging import logging, ProgressReporter
+from lib.stox_utils import *
+from lib.buy_sell_v3 import (load_sim_prices, load_bench_prices, hold_trades,
+    whole_shares, trade_gains)
+from lib.parallel import get_workers, symbol_shards
+from lib.price_arena import map_arena_shards
+from lib.analyze import analyze_trades, analysis_postfix, append_analysis_csv
+from lib.background_writer import BackgroundWriter
+
+
+# Buy-sell + analyze for every hold time and budget in the config.
+# The filtered prices are loaded once.  For each shard of symbols the
+# buy/sell pairs are built once per hold time and the budgets are a
+# broadcast dimension over them (budgets x trades arrays), so each
+# analysis_<hold>_days_<budget>_dollars.csv is made without writing and
+# re-reading the BUY_SELL_RESULTS_FILE.
+#
+# The benchmark_files prices are simulated in the same pass as extra
+# shards and their rows go to the bench_analysis_ files.  With universe
+# off only the benchmarks are run.
+
+def buy_sell_matrix(cfg, universe=True):
+
+    prices_input_store = FILTERED_PRICES_STORE
+    holds, budgets = get_holds_budgets(cfg)
+    fee_dollars = float(cfg['tx_fee'])
+    low_price_cutoff = float(cfg['low_price_cutoff'])
+    min_trades = int(cfg['analyze_min_trades'])
+    workers = get_workers(cfg)
+
+    # shards of symbols (in symbol, date order) and their output prefixes
+    shards = []
+    prefixes = []
+    if universe:
+        stox_df = load_sim_prices(prices_input_store)
+        shards += symbol_shards(stox_df, workers)
+        prefixes += [ANALYSIS_FILE_PREFIX] * (len(shards) - len(prefixes))
+
+    bench_df = load_bench_prices(cfg)
+    if bench_df is not None:
+        shards += symbol_shards(bench_df, workers)
+        prefixes += [BENCH_ANALYSIS_FILE_PREFIX] * (len(shards) - len(prefixes))
+
+    numsyms = sum(shard_df['symbol'].nunique() for shard_df in shards)
+    logging.info(f"Running {len(holds)} holds x {len(budgets)} budgets " +
+                 f"for {numsyms} symbols")
+
+    budget_arr = np.array(budgets, dtype=float)
+    results = {(p, h, b): [] for p in set(prefixes) 
+               for h in holds for b in budgets}  # analysis frames
+
+    shard_results = map_arena_shards(matrix_shard, shards, workers, holds,
+                                     budget_arr, fee_dollars, low_price_cutoff,
+                                     min_trades)
+
+    progress = ProgressReporter(numsyms, "symbols simulated")
+    for shard_df, prefix, shard_rows in zip(shards, prefixes, shard_results):
+
+        for (h, b), rows_df in shard_rows.items():
+            results[(prefix, h, b)].append(rows_df)
+
+        progress.update(shard_df['symbol'].nunique())
+
+    progress.finish()
+
+    # each file is written by a background thread while the next is built
+    with BackgroundWriter() as writer:
+
+        for (prefix, h, b), frames in results.items():
+            analysis_output_file = prefix + analysis_postfix(h, b)
+
+            # clean up the existing output file (ignore !exists error)
+            try:
+                os.remove(analysis_output_file)
+            except OSError:
+                pass   
+
+            results_df = pd.concat(frames)
+            if len(results_df) > 0:
+                logging.info(f"Writing {len(results_df)} results to {analysis_output_file}")
+                writer.submit(append_analysis_csv, analysis_output_file,
+                              results_df, True)
+
+
+# Analysis rows for every hold and budget for a shard of symbols.
+# Returns {(hold, budget): rows frame}.
+def matrix_shard(prices_df, holds, budget_arr, fee_dollars, low_price_cutoff,
+                 min_trades):
+
+    results = {}
+    for h in holds:
+        trades_df = hold_trades(prices_df, h)
+        for b, rows_df in matrix_analysis(trades_df, budget_arr, fee_dollars,
+                                       low_price_cutoff, min_trades):
+            results[(h, b)] = rows_df
+
+    return results
+
+
+# Analysis rows for each budget over one hold time's buy/sell pairs.
+# Yields (budget, rows frame) for each budget in budget_arr.
+def matrix_analysis(trades_df, budget_arr, fee_dollars, low_price_cutoff,
+                    min_trades):
+
+    buy_price = trades_df['buy_price'].to_numpy()
+    sell_price = trades_df['sell_price'].to_numpy()
+    split_ratio = trades_df['split_ratio'].to_numpy()
+
+    # budgets x trades
+    shares_bought = whole_shares(buy_price[None, :], budget_arr[:, None])
+    shares_sold = shares_bought * split_ratio[None, :]
+    gains = trade_gains(buy_price[None, :], sell_price[None, :],
+                        shares_bought, shares_sold, fee_dollars)
+
+    # same rows as are kept in the buy-sell results file
+    keep = (shares_bought > 0) & (buy_price > low_price_cutoff)[None, :]
+
+    # values as they read back from the results file (3 decimals)
+    base_df = pd.DataFrame({
+        'symbol': trades_df['symbol'].array,
+        'buy_date': trades_df['buy_date'].to_numpy(),
+        'buy_price': csv_round(buy_price),
+        'sell_date': trades_df['sell_date'].to_numpy(),
+        'sell_price': csv_round(sell_price)})
+
+    for k, budget in enumerate(budget_arr):
+        bsr_df = base_df.assign(gain_total=csv_round(gains[k]))[keep[k]]
+        yield float(budget), analyze_trades(bsr_df, min_trades)
@@ -4,195 +4,395 @@ import os.path
 import sys
 from math import floor
 from datetime import datetime, timedelta
-from lib.ntlogging import logging
-from lib.stox_utils import FILTERED_PRICES_FILE, BUY_SELL_RESULTS_FILE
+from lib.ntlogging import logging, ProgressReporter
+from lib.stox_utils import (FILTERED_PRICES_STORE, BUY_SELL_RESULTS_FILE,
+    ANALYSIS_FILE_PREFIX, BENCHMARK_PRICES_FILE, split_factor_index, csv_round,
+    get_benchmark_files)
+from lib.price_store import read_price_store, INDEX_FILE
+from lib.parallel import get_workers, symbol_shards
+from lib.price_arena import map_arena_shards
+from lib.trading_calendar import (to_days, config_days, day_strings,
+                                  TradingCalendar)
+from lib.analyze import TradeStats, analysis_postfix, append_analysis_csv
+from lib.background_writer import BackgroundWriter
+
+# columns for the buy-sell results file
+RESULT_COLS = ['symbol', 'interval', 'trading_days_held', 'cal_days_held',
+               'buy_date', 'shares_bought', 'buy_price', 'sell_date', 
+               'shares_sold', 'sell_price', 'fee', 'gain_total']
+
+# share lower price limit
+PRICE_EPSILON = .0001
 
 # This builds a result row for every trading day in the set.
-# Transactions that are pending sale until the hold period is reached
-# are put into the pending_lst.
-# A sale will close out the first item from the pending list, adjust the shares
-# owned at the sell date by the split coefficients, and append the sale
-# to  the results_lst.  The final dataframe is built from the results_lst.
+# A buy is made on every trading day and sold hold_days trading days later.
+# Rather than walking each row, the whole price frame (sorted by symbol
+# and date) is simulated with array operations: the sell for the buy at row
+# i is row i + hold_days of the same symbol.  The shares owned at the sell
+# date are adjusted by the split coefficients of the rows in between, read
+# off the per-symbol split factor index built when the prices are loaded.
+#
+# Each shard's trades are also folded into per-symbol stats as they are
+# made, so the analysis file for this hold and budget is written here
+# without re-reading the results.  The full trade log (the results file)
+# is only written with write_trade_log on.
+#
+# With benchmark_excess on, each trade also gets the benchmark's return
+# (BENCHMARK_PRICES_FILE) over the same buy and sell dates and the trade's
+# excess return over it, both in percent.
 
 def buy_sell_v3(cfg):
 
-    prices_input_file = FILTERED_PRICES_FILE
+    prices_input_store = FILTERED_PRICES_STORE
     buy_sell_output_file = BUY_SELL_RESULTS_FILE
     budget_dollars = float(cfg['budget_dollars'])
     fee_dollars = float(cfg['tx_fee'])
     hold_days = int(cfg['stock_hold_time'])
     low_price_cutoff = float(cfg['low_price_cutoff'])
+    workers = get_workers(cfg)
+    write_log = cfg.getboolean('write_trade_log', fallback=True)
+    bench_excess = cfg.getboolean('benchmark_excess', fallback=False)
+    min_trades = int(cfg['analyze_min_trades'])
+    analysis_output_file = (ANALYSIS_FILE_PREFIX + 
+        analysis_postfix(hold_days, budget_dollars))
+
+    # clean up the existing output files (ignore !exists error)
+    for output_file in [BUY_SELL_RESULTS_FILE, analysis_output_file]:
+        try:
+            os.remove(output_file)
+        except OSError:
+            pass   
+
+    # load prices in symbol, date order
+    stox_df = load_sim_prices(prices_input_store)
+    if bench_excess:
+        bench_calendar, bench_values = load_bench_series(BENCHMARK_PRICES_FILE)
+
+    shards = symbol_shards(stox_df, workers)
+    numsyms = stox_df['symbol'].nunique()  # total number of symbols
+    logging.info("Found " + str(numsyms) + " symbols in price data.")
+
+    cant_afford = set()  # set of symbols whose unit share price exceeds budget
+    penny_stocks = set()  # set of low price symbols
+
+    stats = TradeStats()  # per-symbol analysis stats
+    write_header = True  # results file header (write once flag)
+    progress = ProgressReporter(numsyms, "symbols simulated")
+
+    # simulate a shard of symbols at a time to bound the results memory,
+    # shards are written in symbol order as they complete
+    sim_results = map_arena_shards(buy_sell_frame, shards, workers,
+                                   budget_dollars, hold_days, fee_dollars)
+
+    # the results files are written by a background thread while the
+    # next shards are simulated, all written when the with block ends
+    with BackgroundWriter() as writer:
+
+        for shard_df, (out_df, high_syms, low_syms) in zip(shards, sim_results):
+
+            cant_afford.update(high_syms)
+            penny_stocks.update(low_syms)
+
+            out_df = kept_trades(out_df, low_price_cutoff)
+            if bench_excess:
+                out_df = bench_returns(out_df, bench_calendar, bench_values)
+            batch_df = stats.update(csv_values(out_df))
+
+            if write_log and len(out_df) > 0:
+                logging.debug(f"Writing {len(out_df)} results to {BUY_SELL_RESULTS_FILE}")
+                writer.submit(append_csv, BUY_SELL_RESULTS_FILE, out_df, write_header)
+                write_header = False
+
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                log_symbol_stats(shard_df, batch_df)
+            progress.update(shard_df['symbol'].nunique())
+
+        progress.finish()
+        logging.info("Zero shares bought (price exceeds budget): " + 
+                     str(cant_afford))
+        logging.info("Zero shares bought (price too low): " + 
+                     str(penny_stocks))
+
+        results_df = stats.rows(min_trades)
+        if len(results_df) > 0:
+            logging.info(f"Writing {len(results_df)} results to {analysis_output_file}")
+            writer.submit(append_analysis_csv, analysis_output_file, results_df, True)
+
+
+# A DEBUG line per symbol of a shard: price days, max gain and max loss
+# (0 when the symbol had no winning or no losing trade)
+def log_symbol_stats(shard_df, batch_df):
+
+    days = shard_df.groupby('symbol', observed=True).size()
+    gains = batch_df['max_gain'].reindex(days.index).fillna(0.0)
+    losses = batch_df['max_loss'].reindex(days.index).fillna(0.0)
+    for symbol, n, gain, loss in zip(days.index, days, gains, losses):
+        logging.debug(f"{symbol} \ttrade days: {n} max_gain: {gain:.2f} " +
+                      f"max_loss: {loss:.2f}")
+
+
+# Loaded price stores kept for the next stage: {store: (stamp, frame)}.
+# Off (None) in the menu, the cli turns it on for pipelines.
+loaded_prices = None
+
+
+def keep_loaded_prices():
+
+    global loaded_prices
+    if loaded_prices is None:
+        loaded_prices = {}
+
+
+# Use a frame already in memory (e.g. from a price arena) as a store's
+# loaded prices
+def use_loaded_prices(prices_input_store, stox_df):
+
+    keep_loaded_prices()
+    loaded_prices.clear()
+    loaded_prices[prices_input_store] = (store_stamp(prices_input_store), stox_df)
+
+
+def clear_loaded_prices():
+
+    if loaded_prices is not None:
+        loaded_prices.clear()
+
+
+# Load a price store (symbol, date order) with the split factor index
+def load_sim_prices(prices_input_store):
+
+    stamp = store_stamp(prices_input_store)
+    if loaded_prices is not None and prices_input_store in loaded_prices:
+        if loaded_prices[prices_input_store][0] == stamp:
+            logging.info("Reusing: " + prices_input_store)
+            return loaded_prices[prices_input_store][1]
+
+    sim_cols = ['open', 'close', 'split_coefficient']
+    try:
+        logging.info("Reading: " + prices_input_store)
+        stox_df = read_price_store(prices_input_store, columns=sim_cols)
+        stox_df['split_factor'] = split_factor_index(stox_df)
+        
+    except Exception as e:
+        logging.warning("Not parsed: " + prices_input_store + "\n" + str(e))
+        sys.exit()
+
+    if loaded_prices is not None:
+        loaded_prices.clear()  # only the latest store
+        loaded_prices[prices_input_store] = (stamp, stox_df)
+
+    return stox_df
+
+
+# Size and mtime of a store's index (changes when the store is rewritten)
+def store_stamp(store_dir):
 
-    # clean up the existing output file (ignore !exists error)
     try:
-        os.remove(BUY_SELL_RESULTS_FILE)
+        stat = os.stat(os.path.join(store_dir, INDEX_FILE))
+        return (stat.st_size, stat.st_mtime_ns)
     except OSError:
-        pass   
+        return None
+
+
+# Load the benchmark_files prices in the date span (symbol, date order)
+# with the split factor index.  None if there are no benchmarks.
+def load_bench_prices(cfg):
+
+    start_day, end_day = config_days(cfg)
+    sim_cols = ['symbol', 'date', 'open', 'close', 'split_coefficient']
+
+    frames = []
+    for bench_file in get_benchmark_files(cfg):
+        try:
+            logging.info("Reading: " + bench_file)
+            bench_df = pd.read_csv(bench_file, usecols=sim_cols)
+            bench_df['date'] = to_days(bench_df['date'])
+
+        except Exception as e:
+            logging.warning("Not parsed: " + bench_file + "\n" + str(e))
+            sys.exit()
+
+        frames.append(bench_df)
+
+    if len(frames) == 0:
+        return None
+
+    bench_df = pd.concat(frames, ignore_index=True)
+    bench_df = bench_df[(bench_df['date'] >= start_day) &
+                        (bench_df['date'] <= end_day)]
+    bench_df = bench_df.sort_values(['symbol', 'date'], kind='stable')
+    bench_df = bench_df.reset_index(drop=True)
+    bench_df['split_factor'] = split_factor_index(bench_df)
+
+    return bench_df
+
+
+# Trading calendar and split adjusted mid prices (the value of the shares
+# from one share held since the first date) on each of its days of a
+# benchmark price file
+def load_bench_series(bench_file):
 
-    # load prices and group by symbol
     try:
-        logging.info("Reading: " + prices_input_file)
-        stox_df = pd.read_table(prices_input_file, sep=',')
-        stox_df['date'] = pd.to_datetime(stox_df['date'])
-        stox_df = stox_df.groupby('symbol')
-        logging.info("Found " + str(len(stox_df)) + " symbols in price data.")
-        
+        logging.info("Reading: " + bench_file)
+        bench_df = pd.read_csv(bench_file, usecols=['symbol', 'date', 'open', 
+                                                    'close', 'split_coefficient'])
+        bench_df['date'] = to_days(bench_df['date'])
+
     except Exception as e:
-        logging.warning("Not parsed: " + prices_input_file + "\n" + str(e))
+        logging.warning("Not parsed: " + bench_file + "\n" + str(e))
         sys.exit()
-    
-    
-    numsyms = len(stox_df)  # total number of symbols
-    cant_afford = set()  # set of symbols whose unit share price exceeds budget
-    penny_stocks = set()  # set of low price symbols
 
-    results_lst = []  # completed transactions
-    write_header = True  # results file header (write once flag)
+    bench_df = bench_df.sort_values('date', kind='stable').reset_index(drop=True)
+    bench_values = mid_prices(bench_df) * split_factor_index(bench_df)
+
+    # one value per day (the last row of a repeated date)
+    last = ~bench_df['date'].duplicated(keep='last').to_numpy()
+
+    return TradingCalendar(bench_df['date']), bench_values[last]
+
+
+# Add the benchmark return over each trade's buy and sell dates and the
+# trade's excess return over it (percent).  The benchmark values are
+# looked up as of each date (the last benchmark date on or before it).
+def bench_returns(out_df, bench_calendar, bench_values):
+
+    buy_value = asof_values(out_df['buy_date'], bench_calendar, bench_values)
+    sell_value = asof_values(out_df['sell_date'], bench_calendar, bench_values)
+
+    cost = out_df['shares_bought'].to_numpy() * out_df['buy_price'].to_numpy()
+    trade_return = 100.0 * out_df['gain_total'].to_numpy() / cost
+    bench_return = 100.0 * (sell_value / buy_value - 1.0)
+
+    return out_df.assign(bench_return=bench_return,
+                         excess_return=trade_return - bench_return)
+
+
+# Values as of each day in a series with a value per calendar day (NaN
+# before the first)
+def asof_values(days, calendar, series_values):
+
+    idx = calendar.index(days)
+    values = series_values[np.clip(idx, 0, None)]
+
+    return np.where(idx >= 0, values, np.nan)
+
+
+# Simulate every buy-sell transaction in a frame sorted by symbol and date
+# (with the split_factor column from stox_utils.split_factor_index).
+# Returns the results frame (in symbol, interval order) and the sets of
+# symbols that had rows priced over budget or under the price epsilon.
+def buy_sell_frame(prices_df, budget_dollars, hold_days, fee_dollars):
+
+    sym = prices_df['symbol'].array
+    mid_price = mid_prices(prices_df)
+    shares = whole_shares(mid_price, budget_dollars)
+
+    price_low = mid_price < PRICE_EPSILON
+    price_high = ~price_low & (shares < 1)
+    high_syms = set(sym[price_high].unique())
+    low_syms = set(sym[price_low].unique())
+
+    trades_df = hold_trades(prices_df, hold_days)
+    out_df = budget_trades(trades_df, budget_dollars, fee_dollars)
+
+    return out_df, high_syms, low_syms
+
+
+# Budget independent part of the simulation: pair each buy row with the
+# sell row hold_days later in the same symbol.  split_ratio is the number
+# of shares owned at the sell for each share bought.
+def hold_trades(prices_df, hold_days):
+
+    sym = prices_df['symbol'].array  # codes of a categorical, not strings
+    dates = prices_df['date'].to_numpy()
+    split_index = prices_df['split_factor'].to_numpy()
+    mid_price = mid_prices(prices_df)
+
+    # row index within each symbol (the buy 'interval')
+    pos = prices_df.groupby('symbol', sort=False).cumcount().to_numpy()
+
+    # each sell row closes out the buy made hold_days rows earlier
+    sell_idx = np.flatnonzero(pos >= hold_days)
+    buy_idx = sell_idx - hold_days
+
+    cal_days = dates[sell_idx] - dates[buy_idx]
+
+    trades_df = pd.DataFrame({
+        'symbol': sym[buy_idx],
+        'interval': pos[buy_idx],
+        'trading_days_held': hold_days,
+        'cal_days_held': cal_days.astype(np.int64),
+        'buy_date': dates[buy_idx],
+        'buy_price': mid_price[buy_idx],
+        'sell_date': dates[sell_idx],
+        'sell_price': mid_price[sell_idx],
+        # split factors of the rows after the buy, up to and including the sell
+        'split_ratio': split_index[sell_idx] / split_index[buy_idx]})
+
+    return trades_df
+
+
+# Add the shares and gains for one budget to the hold_trades frame
+def budget_trades(trades_df, budget_dollars, fee_dollars):
+
+    out_df = trades_df.copy()
+    shares_bought = whole_shares(out_df['buy_price'].to_numpy(), budget_dollars)
+    shares_sold = shares_bought * out_df['split_ratio'].to_numpy()
+
+    out_df['shares_bought'] = shares_bought
+    out_df['shares_sold'] = shares_sold
+    out_df['fee'] = fee_dollars
+    out_df['gain_total'] = trade_gains(out_df['buy_price'].to_numpy(),
+                                       out_df['sell_price'].to_numpy(),
+                                       shares_bought, shares_sold, fee_dollars)
+
+    return out_df[RESULT_COLS]
+
+
+# Buy/sell price is the mean of the open and close
+def mid_prices(prices_df):
+
+    return ((prices_df['open'].to_numpy(dtype=float) + 
+             prices_df['close'].to_numpy(dtype=float)) / 2.0)
+
+
+# can only buy whole shares, nothing under the price epsilon.
+# prices and budgets broadcast, e.g. budgets[:, None] by prices[None, :]
+def whole_shares(price, budget_dollars):
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = np.floor(budget_dollars / price)
+
+    shares = np.where(price < PRICE_EPSILON, 0, shares)
+
+    return shares.astype(np.int64)
+
+
+def trade_gains(buy_price, sell_price, shares_bought, shares_sold, fee_dollars):
+
+    return shares_sold * sell_price - shares_bought * buy_price - fee_dollars
+
+
+# Drop zero-shares and penny stock transactions
+def kept_trades(out_df, low_price_cutoff):
 
-    # Loop over each symbol
-    symnum = 1  # symbol idx
-    
-    for symbol, sym_df in stox_df:
-
-        max_gain = max_loss = 0.0
-        pending_lst = []   # has buy attributes for each buy date
-
-        # TODO make sure the sym_df is in date order ascending
-
-        row_idx = 0
-        for row in sym_df.itertuples():
-
-            buy_price, shares_bought, status = buy(row, budget_dollars)
-            split_coeff = row.split_coefficient
-
-            if status == 'price_high':
-                cant_afford.add(symbol)  # todo: count these
-            elif status == 'price_low':
-                penny_stocks.add(symbol) # todo: count these
-            
-            # add current row to pending sale list
-            pending_lst.append([symbol, row_idx, row.date, shares_bought, 
-                                buy_price, split_coeff])
-            
-            # Once the pending sales list is full, start creating results list
-            if row_idx >= hold_days:  
-
-                result_row = sell_row(row, pending_lst, fee_dollars)
-
-                returns = float(result_row[11])
-
-                # just for logging
-                if returns > max_gain: max_gain = returns
-                if returns < max_loss: max_loss = returns
-
-                # add the result row to results list
-                results_lst.append(result_row)
-                
-                # remove the sold row 
-                del pending_lst[0]
-
-            row_idx += 1
-
-        # peridocially write the results list
-        qmax = 100000
-        if len(results_lst) >= qmax:
-            logging.info(f"Writing {qmax} results to {BUY_SELL_RESULTS_FILE}")
-            append_csv(BUY_SELL_RESULTS_FILE, results_lst, write_header, low_price_cutoff)
-            write_header = False
-            results_lst = []
-
-        symnum += 1    # keep track of how many symbols have been processed
-        logging.info(f"{symbol} \t\t[{symnum} of {numsyms}] \ttrade days: " +
-                     f"{str(len(sym_df))} max_gain: {max_gain:.2f} " +
-                     f"max_loss: {max_loss:.2f}")
- 
-
-    # final csv update
-    if len(results_lst) > 0:
-        logging.info(f"Writing {len(results_lst)} results to {BUY_SELL_RESULTS_FILE}")
-        append_csv(BUY_SELL_RESULTS_FILE, results_lst, write_header, low_price_cutoff)
-    
-    logging.info("Zero shares bought (price exceeds budget): " + 
-                 str(cant_afford))
-    logging.info("Zero shares bought (price too low): " + 
-                 str(penny_stocks))
-
-
-# Drop unwanted rows and update csv
-def append_csv(csv_file, results_lst, write_header, low_price_cutoff):
-
-    # columns for output dataframe
-    cols = ['symbol', 'interval', 'trading_days_held', 'cal_days_held',
-            'buy_date', 'shares_bought', 'buy_price', 'sell_date', 
-            'shares_sold', 'sell_price', 'fee', 'gain_total']
-
-    out_df = pd.DataFrame(results_lst, columns=cols).sort_values(['symbol', 
-                          'interval'], ascending=True)
-
-    # Drop zero-shares transactions
     out_df = out_df[out_df.shares_bought > 0]
 
-    # drop penny stock transactions
-    out_df = out_df[out_df.buy_price > low_price_cutoff]
+    return out_df[out_df.buy_price > low_price_cutoff]
+
 
+# Trades with the prices and gains as they read back from the results file
+def csv_values(out_df):
+
+    float_cols = ['buy_price', 'sell_price', 'gain_total', 'excess_return']
+    return out_df.assign(**{col: csv_round(out_df[col].to_numpy()) 
+                            for col in float_cols if col in out_df})
+
+
+def append_csv(csv_file, out_df, write_header):
+
+    out_df = out_df.assign(buy_date=day_strings(out_df['buy_date']),
+                           sell_date=day_strings(out_df['sell_date']))
     with open(csv_file, 'a') as f:
         out_df.to_csv(f, index=False, sep=",", float_format='%.3f', 
                       header=write_header)
-
-
-def sell_row(row, pending_lst, fee):
-
-    sold_row = pending_lst[0]
-    symbol = sold_row[0]
-    idx = sold_row[1]
-    buy_date = sold_row[2]
-    shares_bought = sold_row[3]
-    buy_price = sold_row[4]
-    cost_dollars = shares_bought * buy_price
-
-    # update num shares owned 
-    shares_owned = shares_bought
-    split_coeff = 1  # default, shouldnt need
-    for pending_row in pending_lst[1:]:
-        split_coeff = pending_row[5]
-        split_coeff_str = f"{split_coeff:.1}"    
-        if split_coeff_str != "1e+00":
-            shares_owned = shares_owned * split_coeff
-
-    sell_date = row.date
-    sell_price = (float(row.open) + float(row.close)) / 2.0
-    sold_dollars = shares_owned * sell_price
-
-    cal_days = (sell_date - buy_date).days
-    trading_days = len(pending_lst) - 1
-    gain_total = sold_dollars - cost_dollars - fee
-
-    result_row = [symbol, idx, trading_days, cal_days,
-                  buy_date, shares_bought, buy_price,
-                  sell_date, shares_owned, sell_price,
-                  fee, gain_total]
-
-    return result_row
-
-    
-def buy(row, budget_dollars):
-    
-    status = "ok"   # 'ok' if shares bought
-                    # 'price_high' if too expensive
-                    # 'price_low' if too cheap
-
-    buy_price = (float(row.open) + float(row.close)) / 2.0
-    shares_bought = 0
-
-    # share lower price limit
-    epsilon = .0001
-    if buy_price < epsilon:
-        status = "price_low"
-    else:
-        # can only buy whole shares
-        shares_bought = floor(budget_dollars / buy_price)
-        if shares_bought < 1:
-            status = "price_high"
-    
-    return buy_price, shares_bought, status
-    
@@ -2,53 +2,280 @@ import pandas as pd
 import numpy as np
 import os.path
 import sys
+import shutil
+from math import ceil
 from datetime import datetime, timedelta
-from lib.ntlogging import logging
+from lib.ntlogging import logging, ProgressReporter
 from lib.stox_utils import *
+from lib.parallel import get_workers, symbol_shards, map_shards
+from lib.price_store import (PriceStoreWriter, read_price_store,
+                             read_store_index, export_price_store)
+from lib.symbol_codes import write_symbol_codes
+from lib.metrics import report_rows
+from lib.trading_calendar import to_days, day_strings, DAY_DTYPE
 
-def load_df(df_file):
 
-    try:
-        logging.info("Reading " + df_file)
-        df = pd.read_table(df_file, sep=',')
-        logging.info("df shape " + str(df.shape))
-        
-    except Exception as e: 
-        logging.critical("Not parsed: " + df_file + "\n" + str(e))
-        sys.exit()   
+# The raw prices are cleaned as a stream of chunks so memory is bounded by
+# the chunk size, not the dataset.  Each symbol must be cleaned whole (the
+# rolling window is centered and the rows are date sorted), so the rows of
+# the last symbol in a chunk are carried into the next chunk.  That needs
+# the raw file grouped by symbol; if a symbol turns up again after its
+# group ended, the file is first partitioned by symbol into bucket files
+# of about one chunk each (an external sort) and the buckets are cleaned.
+#
+# Incremental cleaning: the last raw date cleaned for each symbol (its
+# watermark) is kept in CLEAN_WATERMARKS_FILE.  With incremental_clean on,
+# only rows within one window of a symbol's new rows can change, so only
+# that tail is re-cleaned (from one more window of context) and spliced
+# onto the symbol's unchanged rows from the existing store.  Raw rows at
+# or before a watermark are assumed not to have changed.
+#
+# The symbol dictionary (lib/symbol_codes.py) is rewritten from the new
+# store's symbols after each clean.
 
-    return df
-     
+class SymbolsNotGrouped(Exception):
+    pass
 
 
 def clean_prices(cfg):
 
     prices_input_file = RAW_PRICES_INPUT_FILE
-    prices_output_file = CLEANED_PRICES_FILE
+    prices_output_store = CLEANED_PRICES_STORE
+    window = int(cfg['rolling_sample_window'])
+    workers = get_workers(cfg)
+    chunk_rows = int(cfg.get('clean_chunk_rows', '1000000'))
+    csv_file = csv_export_file(cfg, CLEANED_PRICES_FILE)
+
+    watermarks = None
+    if cfg.getboolean('incremental_clean', fallback=False):
+        watermarks = read_watermarks(window)
+
+    # incremental cleans read the old store while writing the new one
+    if watermarks is not None:
+        logging.info(f"Incremental clean from {len(watermarks)} watermarks")
+        old_store = prices_output_store
+        prices_output_store = prices_output_store.rstrip("/") + "_new/"
+    else:
+        logging.info(f"Full clean with window = {window}")
+        old_store = None
  
-    # clean up the existing output file (ignore !exists error)
+    # replaces the existing store
+    writer = PriceStoreWriter(prices_output_store)
+
     try:
-        os.remove(prices_output_file)
-    except OSError:
-        pass   
+        chunks = symbol_chunks(prices_input_file, chunk_rows)
+        last_dates = clean_chunks(chunks, writer, window, workers,
+                                  watermarks, old_store)
+
+    except SymbolsNotGrouped as e:
+        logging.warning(f"{prices_input_file} is not grouped by symbol " +
+                        f"({e}), partitioning by symbol first.")
+        writer = PriceStoreWriter(prices_output_store)
+        chunks = partitioned_chunks(prices_input_file, chunk_rows)
+        last_dates = clean_chunks(chunks, writer, window, workers,
+                                  watermarks, old_store)
+
+    writer.close()
+
+    if old_store is not None:
+        shutil.rmtree(old_store)
+        os.rename(prices_output_store, old_store)
+
+    # chunks (and buckets) are not in symbol order, the export is
+    if csv_file is not None:
+        export_price_store(CLEANED_PRICES_STORE, csv_file)
+
+    write_watermarks(last_dates, window)
+    write_symbol_codes(read_store_index(CLEANED_PRICES_STORE)['symbol'])
+
+
+# Clean frames of whole symbols and append them to the store writer.
+# Returns the last raw date of each symbol.
+def clean_chunks(chunks, writer, window, workers, watermarks=None,
+                 old_store=None):
+
+    rows_in = rows_out = 0
+    last_dates = []
+    progress = ProgressReporter(None, "rows cleaned")
+    for chunk_df in chunks:
+
+        chunk_df = chunk_df.copy()
+        chunk_df['date'] = to_days(chunk_df['date'])
+        last_dates.append(chunk_df.groupby('symbol')['date'].max())
+
+        if watermarks is not None:
+            clean_df = splice_chunk(chunk_df, window, watermarks, old_store)
+        elif workers > 1:
+            chunk_df = chunk_df.sort_values('symbol', kind='stable')
+            shards = symbol_shards(chunk_df, workers)
+            clean_df = pd.concat(map_shards(clean_outliers_frame, shards,
+                                            workers, window))
+        else:
+            clean_df = clean_outliers_frame(chunk_df, window)
+
+        # one write per chunk
+        writer.append(clean_df)
+
+        rows_in += len(chunk_df)
+        rows_out += len(clean_df)
+        progress.update(len(chunk_df),
+                        detail=f"Cleaned {rows_in} rows, kept {rows_out}")
+
+    progress.finish()
+    logging.info(f"Cleaned {rows_in} rows, kept {rows_out}")
+    report_rows(rows_in, rows_out)
+
+    if len(last_dates) == 0:
+        return pd.Series(dtype=DAY_DTYPE)
+
+    return pd.concat(last_dates)
+
+
+# Incrementally clean a chunk of whole symbols against their watermarks
+def splice_chunk(chunk_df, window, watermarks, old_store):
+
+    chunk_df = chunk_df.sort_values(['symbol', 'date'], kind='stable')
+    chunk_df = chunk_df.reset_index(drop=True)
+    watermark = symbol_lookup(watermarks, chunk_df)
+
+    # symbols with rows after their watermark (or no watermark) changed
+    changed = (watermark.isna() | (chunk_df['date'] > watermark))
+    changed = changed.groupby(chunk_df['symbol']).transform('any')
+
+    # rows of the tradable series at or before the watermark
+    tradable_df = chunk_df[tradable_rows(chunk_df) & changed]
+    pos = tradable_df.groupby('symbol').cumcount()
+    num_old = (tradable_df['date'] <= watermark[tradable_df.index])
+    num_old = num_old.groupby(tradable_df['symbol']).transform('sum')
+
+    # rows from num_old - window on can change, they need another window
+    # of context before them
+    tail_df = tradable_df[pos >= num_old - 2 * window]
+    splice_pos = (num_old - window).clip(lower=0)
+    splice_date = (tradable_df['date'].where(pos == splice_pos)
+                   .groupby(tradable_df['symbol']).max())
+    splice_date = splice_date[splice_pos.groupby(tradable_df['symbol']).max() > 0]
+
+    new_df = clean_outliers_frame(tail_df, window)
+    splice_at = symbol_lookup(splice_date, new_df)
+    new_df = new_df[splice_at.isna() | (new_df['date'] >= splice_at)]
+
+    # unchanged symbols and the heads of changed symbols from the old store
+    old_symbols = chunk_df.loc[chunk_df['symbol'].isin(watermarks.index), 
+                               'symbol'].unique()
+    old_df = read_price_store(old_store, symbols=old_symbols)
+    head_end = symbol_lookup(splice_date, old_df)
+    changed_syms = set(chunk_df.loc[changed, 'symbol'])
+    keep_old = ~old_df['symbol'].isin(changed_syms) | (old_df['date'] < head_end)
+    old_df = old_df[keep_old]
 
-    # load prices
-    prices_df = load_df(prices_input_file).groupby('symbol')
+    clean_df = pd.concat([old_df, new_df[old_df.columns]], ignore_index=True)
+    logging.info(f"Re-cleaned {len(changed_syms)} changed symbols, " +
+                 f"{len(new_df)} new rows")
 
-    write_header = True
+    return clean_df.sort_values(['symbol', 'date'], kind='stable')
 
-    # Clean outliers 
-    for symbol, sym_df in prices_df:
 
-        sym_df = prices_df.get_group(symbol)
-        logging.info(f"Cleaning outliers for {symbol}")
-        sym_df = clean_outliers(sym_df, cfg['rolling_sample_window'])
+# Per symbol days for each row of a frame (NaN for missing symbols)
+def symbol_lookup(sym_days, df):
+
+    values = sym_days.reindex(df['symbol']).to_numpy(dtype=float)
+
+    return pd.Series(values, index=df.index)
+
+
+# The watermarks of the last clean, if it used this window
+def read_watermarks(window):
+
+    if not (os.path.exists(CLEAN_WATERMARKS_FILE) and 
+            os.path.exists(CLEANED_PRICES_STORE)):
+        return None
+
+    wm_df = pd.read_csv(CLEAN_WATERMARKS_FILE, keep_default_na=False,
+                        dtype={'symbol': str})
+    if len(wm_df) == 0 or int(wm_df['window'].iloc[0]) != window:
+        logging.info("Rolling window changed since the last clean.")
+        return None
+
+    return pd.Series(to_days(wm_df['last_date']), index=wm_df['symbol'])
+
+
+def write_watermarks(last_dates, window):
+
+    wm_df = pd.DataFrame({'symbol': last_dates.index,
+                          'last_date': day_strings(last_dates.to_numpy()),
+                          'window': window})
+    wm_df.to_csv(CLEAN_WATERMARKS_FILE, index=False)
+    logging.info(f"Wrote {len(wm_df)} watermarks to {CLEAN_WATERMARKS_FILE}")
+
+
+def read_chunks(csv_file, chunk_rows):
+
+    try:
+        logging.info(f"Reading {csv_file} in chunks of {chunk_rows} rows")
+        return pd.read_csv(csv_file, chunksize=chunk_rows)
         
-        with open(prices_output_file, 'a') as f:
-            sym_df.to_csv(f, index=False, sep=",", header=write_header)
-            write_header = False
+    except Exception as e: 
+        logging.critical("Not parsed: " + csv_file + "\n" + str(e))
+        sys.exit()   
+
+
+# Yield frames of whole symbols from a csv grouped by symbol.  The rows of
+# the last symbol of each chunk are held back until the symbol ends.
+# Raises SymbolsNotGrouped if a symbol's rows are not contiguous.
+def symbol_chunks(csv_file, chunk_rows):
+
+    done = set()  # symbols whose rows have ended
+    carry_df = None
+    for chunk_df in read_chunks(csv_file, chunk_rows):
+
+        if carry_df is not None:
+            chunk_df = pd.concat([carry_df, chunk_df], ignore_index=True)
+
+        sym = chunk_df['symbol'].to_numpy()
+        runs = np.concatenate(([0], np.flatnonzero(sym[1:] != sym[:-1]) + 1))
+        run_syms = sym[runs]
+
+        if len(set(run_syms)) < len(run_syms) or not done.isdisjoint(run_syms):
+            repeated = [s for s in run_syms if s in done] or list(run_syms)
+            raise SymbolsNotGrouped(f"{repeated[0]} seen again")
+
+        done.update(run_syms[:-1])
+        carry_df = chunk_df.iloc[runs[-1]:]
+        if runs[-1] > 0:
+            yield chunk_df.iloc[:runs[-1]]
 
-                   
+    if carry_df is not None and len(carry_df) > 0:
+        yield carry_df
 
-    
-    
+
+# Partition a csv into bucket files by a hash of the symbol, so each
+# bucket holds whole symbols and about chunk_rows rows, then yield the
+# buckets one at a time.
+def partitioned_chunks(csv_file, chunk_rows):
+
+    bucket_dir = STOX_DATA_DIR + "clean_buckets/"
+    shutil.rmtree(bucket_dir, ignore_errors=True)
+    os.makedirs(bucket_dir)
+
+    # about 70 bytes a row in the raw file
+    num_buckets = max(1, ceil(os.path.getsize(csv_file) / 70 / chunk_rows))
+    bucket_files = [f"{bucket_dir}bucket_{b:04d}.csv" for b in range(num_buckets)]
+    logging.info(f"Partitioning {csv_file} into {num_buckets} buckets")
+
+    write_header = [True] * num_buckets
+    for chunk_df in read_chunks(csv_file, chunk_rows):
+
+        sym = chunk_df['symbol'].astype(str).to_numpy()
+        bucket = pd.util.hash_array(sym) % num_buckets
+        for b, bucket_df in chunk_df.groupby(bucket):
+            with open(bucket_files[b], 'a') as f:
+                bucket_df.to_csv(f, index=False, header=write_header[b])
+            write_header[b] = False
+
+    try:
+        for b, bucket_file in enumerate(bucket_files):
+            if not write_header[b]:
+                yield pd.read_csv(bucket_file)
+    finally:
+        shutil.rmtree(bucket_dir, ignore_errors=True)
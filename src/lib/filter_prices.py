@@ -5,6 +5,7 @@ import sys
 from datetime import datetime, timedelta
 from lib.ntlogging import logging
 from lib.stox_utils import *
+from lib.price_store import read_price_store, write_price_store
 
 
 def load_df(df_file):
@@ -23,47 +24,30 @@ def load_df(df_file):
 
 def filter_prices(cfg):
 
-    start_list = cfg['date_start'].split('-')
-    start_yr = int(start_list[0])
-    start_mo = int(start_list[1])
-    start_d = int(start_list[2])
-
-    end_list = cfg['date_end'].split('-')
-    end_yr = int(end_list[0])
-    end_mo = int(end_list[1])
-    end_d = int(end_list[2])
-
-    prices_start_date = pd.Timestamp(start_yr, start_mo, start_d)
-    prices_end_date = pd.Timestamp(end_yr, end_mo, end_d)
+    prices_start_date, prices_end_date = get_date_span(cfg)
 
     symbols_input_file = SYMBOLS_FILE
-    prices_input_file = CLEANED_PRICES_FILE
-    filtered_prices_output_file = FILTERED_PRICES_FILE
+    prices_input_store = CLEANED_PRICES_STORE
+    filtered_prices_output_store = FILTERED_PRICES_STORE
  
     # load symbols
     symbols_df = load_df(symbols_input_file)
     symbols = symbols_df['symbol'].tolist()
         
-    # load prices
-    prices_df = load_df(prices_input_file)
-    logging.info("Filtering prices with symbols. ")
-
-    # filter on symbols
-    prices_df = prices_df[prices_df['symbol'].isin(symbols)]
-    logging.info("Filtered symbols df shape " + str(prices_df.shape))
-
-    # filter on date range
-    logging.info("Filtering by date range.")
-    prices_df['date'] = pd.to_datetime(prices_df['date'])
-    prices_df = prices_df[(prices_df['date'] >= prices_start_date) &
-                   (prices_df['date'] <= prices_end_date)].sort_values(
-                   ['symbol', 'date'])
+    # load prices, the symbol and date filters are applied by the store
+    logging.info(f"Reading {prices_input_store} for {len(symbols)} symbols " +
+                 f"from {prices_start_date.date()} to {prices_end_date.date()}")
+    try:
+        prices_df = read_price_store(prices_input_store, symbols=symbols,
+                                     date_start=prices_start_date,
+                                     date_end=prices_end_date)
+    except Exception as e: 
+        logging.critical("Not parsed: " + prices_input_store + "\n" + str(e))
+        sys.exit()
 
-                   
-    logging.info("Filtered dates df shape " + str(prices_df.shape))
+    logging.info("Filtered df shape " + str(prices_df.shape))
 
     # write filtered prices
-    logging.info("Writing filtered prices to " + filtered_prices_output_file)
-    prices_df.to_csv(filtered_prices_output_file, index=False)
-    
-
+    logging.info("Writing filtered prices to " + filtered_prices_output_store)
+    write_price_store(filtered_prices_output_store, prices_df,
+                      csv_export_file(cfg, FILTERED_PRICES_FILE))
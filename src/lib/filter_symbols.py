@@ -5,6 +5,7 @@ import sys
 from datetime import datetime, timedelta
 from lib.ntlogging import logging
 from lib.stox_utils import *
+from lib.trading_calendar import to_days, day_of
 
 
 def filter_symbols(cfg):
@@ -34,16 +35,17 @@ def filter_symbols(cfg):
     try:
         logging.info("Reading: " + summary_input_file)
         stox_df = pd.read_table(summary_input_file, sep=',')
-        stox_df['stock_from_date'] = pd.to_datetime(stox_df['stock_from_date'])
-        stox_df['stock_to_date'] = pd.to_datetime(stox_df['stock_to_date'])
+        stox_df = stox_df.dropna(subset=['stock_from_date', 'stock_to_date'])
+        stox_df['stock_from_date'] = to_days(stox_df['stock_from_date'])
+        stox_df['stock_to_date'] = to_days(stox_df['stock_to_date'])
 
     except Exception as e:
         logging.warning("Not parsed: " + summary_input_file + "\n" + str(e))
         sys.exit()
         
     # drop any symbols that don't cover at least the analysis window
-    stox_df = stox_df[(stox_df['stock_from_date'] <= PRICES_START_DATE) &
-                    (stox_df['stock_to_date'] >= PRICES_END_DATE)]
+    stox_df = stox_df[(stox_df['stock_from_date'] <= day_of(PRICES_START_DATE)) &
+                    (stox_df['stock_to_date'] >= day_of(PRICES_END_DATE))]
 
     logging.info("Done filtering symbols.\n")
 
@@ -6,100 +6,68 @@ from math import floor
 from datetime import datetime, timedelta
 from lib.ntlogging import logging
 from lib.stox_utils import *
+from lib.analyze import analysis_postfix
 
 
-# for a symbol, get the pct_black for each of the holds
-#  return a row with the pct_black for each hold plus the avg
-# def get_avg_blk(symbol, df_list):
-
-#     pct_blk = 0
-#     for df in df_list:
-#         # get the value at col 'pct_black' from the symbol row
-#         #  here there should be only one result -> values[0]
-#         pct_blk = df.loc[df.symbol == symbol, 'pct_black'].values[0]
-#         print(f"pct_blk {pct_blk}")
-
-#     sys.exit()
+# Blacklist for each budget in budget_list: the symbols found in the
+# analysis file of every hold in hold_times_list with pct_black over the
+# cutoff, with their pct_black for each hold (d<hold> columns), the mean
+# of their avg_return and the mean pct_black (avg_pct_blk).
 
 def make_blacklist(cfg):
 
     pct_cutoff = 0.51
-
-    file_list = [
-        'analysis_4_days_1000_dollars.csv',
-        'analysis_9_days_1000_dollars.csv',
-        'analysis_14_days_1000_dollars.csv',
-        'analysis_19_days_1000_dollars.csv',
-        'analysis_30_days_1000_dollars.csv',
-        'analysis_60_days_1000_dollars.csv',
-        'analysis_90_days_1000_dollars.csv'
-    ]
-    df_list = []  # keep each df 
-
-    logging.info(f"Loading {file_list[0]}")
-    df = pd.read_table(STOX_DATA_DIR + file_list[0], sep=",")
-    logging.info(f"file0 df shape: {df.shape}")
-
-    df = df[df.pct_black > pct_cutoff]
-    logging.info(f"file0 df > pct cutoff shape: {df.shape}")
-
-    df_list.append(df)
-
-    keep_symbols = set(df['symbol'].tolist())
-    drop_symbols = set()
-
-    for file in file_list[1:]:
-        logging.info(f"Checking symbols in {file}")
-        df = pd.read_table(STOX_DATA_DIR + file, sep=",")
-        df = df[df['pct_black'] > pct_cutoff]
-        check_symbols = df['symbol'].tolist()
-        for k in keep_symbols:
-            if k not in check_symbols:
-                drop_symbols.add(k)
-        
-        df_list.append(df)
-
-    print(f"{len(drop_symbols)} symbols getting dropped.")
-    #logging.info(str(drop_symbols))
-
-    for d in drop_symbols:
-        keep_symbols.remove(d)
-
-    print(f"{len(keep_symbols)} symbols kept.")
-    print(f"{len(df_list)} dfs made")
-
-
-    # build a df with the pct_black results across all holds
-    cols = ['symbol', 'd4', 'd9', 'd14', 'd19', 'd30', 'd60', 'd90', 'avg_return']
-    rows_list = []
-    i = 0
-    for symbol in keep_symbols:
-        rtn_sum = 0  # to make average return
-        row = [symbol]
-        for df in df_list:
-
-            rtn_sum += df.loc[df.symbol == symbol, 'avg_return'].values[0]
-
-            pct_blk = df.loc[df.symbol == symbol, 'pct_black'].values[0]
-            row.append(pct_blk)
-
-        avg_return = rtn_sum / float(len(file_list))
-        row.append(avg_return)        
-        rows_list.append(row)
-        i += 1
-        if((i % 100) == 0): 
-            logging.info(f"processing symbol {i} of {len(keep_symbols)}")
-
-    # blacklist df
-    logging.info(f"Building blacklist df with {len(rows_list)} rows")
-    bl_df = pd.DataFrame(rows_list, columns=cols)
-    
-    # add column for avg pct_blk
-    bl_df['avg_pct_blk'] = bl_df.iloc[:, 1:8].mean(axis=1)
-    bl_df = bl_df.sort_values('avg_pct_blk', ascending=False)
-
+    holds, budgets = get_holds_budgets(cfg)
+
+    for budget in budgets:
+        build_blacklist(ANALYSIS_FILE_PREFIX, BLACKLIST_FILE_PREFIX, holds,
+                        budget, pct_cutoff)
+
+
+# Join the analysis tables of the holds for one budget on symbol and write
+# <blacklist_prefix><budget>_dollars.csv.  No pct_black cutoff if None.
+def build_blacklist(analysis_prefix, blacklist_prefix, holds, budget,
+                    pct_cutoff=None):
+
+    # one table per hold, loaded once (a hold listed twice is one column)
+    holds = list(dict.fromkeys(holds))
+    frames = []
+    for hold in holds:
+        analysis_file = analysis_prefix + analysis_postfix(hold, budget)
+        try:
+            logging.info(f"Loading {analysis_file}")
+            df = pd.read_csv(analysis_file, keep_default_na=False,
+                             usecols=['symbol', 'pct_black', 'avg_return'])
+
+        except Exception as e:
+            logging.warning("Not parsed: " + analysis_file + "\n" + str(e))
+            sys.exit()
+
+        if pct_cutoff is not None:
+            df = df[df['pct_black'] > pct_cutoff]
+        frames.append(df.assign(hold=hold))
+
+    hold_df = pd.concat(frames, ignore_index=True)
+
+    # symbols x holds, keep the symbols in every table
+    pct_df = hold_df.pivot(index='symbol', columns='hold', values='pct_black')
+    pct_df = pct_df.reindex(columns=holds)  # holds with no symbols left
+    return_df = hold_df.pivot(index='symbol', columns='hold', values='avg_return')
+    return_df = return_df.reindex(columns=holds)
+    keep = pct_df.notna().all(axis=1)
+    logging.info(f"{(~keep).sum()} symbols getting dropped.")
+    logging.info(f"{keep.sum()} symbols kept.")
+
+    bl_df = pct_df.loc[keep, holds]
+    bl_df.columns = [f"d{hold}" for hold in holds]
+    bl_df['avg_return'] = return_df.loc[keep, holds].mean(axis=1)
+    bl_df['avg_pct_blk'] = bl_df.iloc[:, :len(holds)].mean(axis=1)
+
+    bl_df = bl_df.rename_axis('symbol').reset_index()
+    bl_df = bl_df.sort_values(['avg_pct_blk', 'symbol'], 
+                              ascending=[False, True], kind='stable')
     logging.info(f"bl_df shape {bl_df.shape}")
-    print(bl_df.head())
 
-    bl_file = BLACKLIST_FILE_PREFIX + "1000_dollars.csv"
+    bl_file = blacklist_prefix + str(int(float(budget))) + "_dollars.csv"
+    logging.info(f"Writing {len(bl_df)} symbols to {bl_file}")
     bl_df.to_csv(bl_file, index=False, float_format='%.3f')
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import resource
+from datetime import datetime
+import pandas as pd
+from lib.ntlogging import logging
+from lib.stox_utils import *
+
+
+# Stage metrics: one json record per stage run appended to
+# STAGE_METRICS_FILE with the stage's start and end, wall time, rows in
+# its main input and output (e.g. the cleaned store, not the symbol
+# dictionary next to it), the sizes of all its input and output files,
+# peak resident memory (the peak is reset at the start of the stage where
+# /proc allows it), the peak of its largest worker process and the config
+# values the stage uses.
+#
+# A stage that counts its own rows (clean counts the raw rows as it
+# streams them, rather than reading the raw file again here) reports them
+# with report_rows().
+
+last_summary = None  # one line summary of the last stage run
+active = None  # the StageMetrics of the stage running
+
+
+class StageMetrics:
+
+    # inputs, outputs: all the stage's files (for their sizes)
+    # rows: (inputs, outputs) whose rows are counted, default the first
+    # input and output
+    def __init__(self, stage, params, inputs, outputs, rows=None):
+        self.stage = stage
+        self.params = params
+        self.inputs = inputs
+        self.outputs = outputs
+        self.rows = rows if rows is not None else (inputs[:1], outputs[:1])
+        self.reported = {}
+
+    def __enter__(self):
+
+        global active
+
+        self.rows_in = sum(path_rows(path) for path in self.rows[0])
+        self.bytes_in = sum(path_bytes(path) for path in self.inputs)
+        reset_peak_rss()
+        self.children_start = children_usage()
+        self.start = datetime.now()
+        self.timer = time.perf_counter()
+        active = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+
+        global active
+
+        active = None
+        seconds = time.perf_counter() - self.timer
+        end = datetime.now()
+
+        record = {
+            'stage': self.stage,
+            'status': 'ok' if exc_type is None else 'failed',
+            'start': self.start.isoformat(timespec='seconds'),
+            'end': end.isoformat(timespec='seconds'),
+            'seconds': round(seconds, 3),
+            'rows_in': self.reported.get('rows_in', self.rows_in),
+            'rows_out': self.reported.get('rows_out',
+                sum(path_rows(path) for path in self.rows[1])),
+            'bytes_in': self.bytes_in,
+            'bytes_out': sum(path_bytes(path) for path in self.outputs),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'peak_worker_mb': round(peak_worker_mb(self.children_start), 1),
+            'params': self.params}
+
+        write_record(record)
+        return False
+
+
+# Rows counted by the running stage itself (no-op outside a stage)
+def report_rows(rows_in=None, rows_out=None):
+
+    if active is None:
+        return
+    if rows_in is not None:
+        active.reported['rows_in'] = rows_in
+    if rows_out is not None:
+        active.reported['rows_out'] = rows_out
+
+
+# Record a stage that was skipped (its outputs were up to date)
+def record_skipped(stage, params):
+
+    now = datetime.now().isoformat(timespec='seconds')
+    write_record({'stage': stage, 'status': 'skipped', 'start': now, 'end': now,
+                  'seconds': 0.0, 'params': params})
+
+
+def write_record(record):
+
+    global last_summary
+
+    try:
+        with open(STAGE_METRICS_FILE, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        logging.warning("Not written: " + STAGE_METRICS_FILE + "\n" + str(e))
+
+    last_summary = summary_line(record)
+    logging.info(last_summary)
+
+
+def summary_line(record):
+
+    if record['status'] == 'skipped':
+        return f"{record['stage']}: skipped (up to date)"
+
+    line = (f"{record['stage']}: {record['status']} in {record['seconds']:.1f} s, " +
+            f"rows {record['rows_in']:,} in / {record['rows_out']:,} out, " +
+            f"files {record['bytes_in'] / 1e6:,.1f} MB in / " +
+            f"{record['bytes_out'] / 1e6:,.1f} MB out, " +
+            f"peak {record['peak_rss_mb']:,.0f} MB")
+    if record['peak_worker_mb'] > 0:
+        line += f" (+ {record['peak_worker_mb']:,.0f} MB per worker)"
+
+    return line
+
+
+# Rows of a price store or csv file (0 if missing)
+def path_rows(path):
+
+    if os.path.isdir(path):
+        index_file = os.path.join(path, "index.csv")
+        if not os.path.exists(index_file):
+            return 0
+        index_df = pd.read_csv(index_file)
+        return int((index_df['end'] - index_df['start']).sum())
+
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'rb') as f:
+        return max(sum(block.count(b"\n") for block in
+                       iter(lambda: f.read(1 << 20), b"")) - 1, 0)
+
+
+# Size of a file or of every file under a directory (0 if missing)
+def path_bytes(path):
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+
+    return size
+
+
+# cpu seconds and peak resident memory (MB) of the finished worker
+# processes of this process
+def children_usage():
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.0
+
+
+# Peak resident memory (MB) of the largest worker process that ran since
+# start (children_usage() then), 0 if none did.  The kernel keeps one
+# peak for all the children, so a bigger worker of an earlier stage in
+# the same process hides a smaller one's peak (it's then an upper bound).
+def peak_worker_mb(start):
+
+    cpu, peak = children_usage()
+
+    return peak if cpu > start[0] else 0.0
+
+
+# Reset the peak resident memory (VmHWM) of this process
+def reset_peak_rss():
+
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+# Peak resident memory of this process (MB) since the last reset, or
+# since it started without /proc
+def peak_rss_mb():
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError):
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
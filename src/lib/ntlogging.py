@@ -1,6 +1,16 @@
 #ntlogging.py
+import os
+import time
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from datetime import timedelta
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+LOG_FILE = "{0}/{1}.log".format(".", "log-stox")
+LOG_MAX_BYTES = 10485760  # rotate at 10 MB
+LOG_BACKUPS = 5  # keep log-stox.log.1 .. .5
+PROGRESS_SECONDS = 5.0  # min seconds between progress lines
 
 # levels: CRITICAL ERROR WARNING INFO DEBUG NOTSET
 logging.basicConfig(
@@ -9,7 +19,119 @@ logging.basicConfig(
     format='%(levelname)s: %(message)s',
     datefmt='%m/%d/%Y %I:%M:%S %p',
     handlers=[
-        RotatingFileHandler("{0}/{1}.log".format(".", "log-stox"), mode='a', 
-            maxBytes=1048576),
+        RotatingFileHandler(LOG_FILE, mode='a', maxBytes=LOG_MAX_BYTES,
+            backupCount=LOG_BACKUPS),
         logging.StreamHandler()]
     )
+
+log_handlers = list(logging.getLogger().handlers)  # the file and console
+log_listener = None  # background writer when the queue is on
+
+
+# Queue mode: records are put on a queue and formatted and written by a
+# background thread, so the hot loops don't wait on the console and file.
+# Started by the scripts (not on import), so worker processes log
+# directly: spawned ones never start it and forked ones drop it.
+def start_log_queue():
+
+    global log_listener
+
+    if log_listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, *log_handlers,
+                                 respect_handler_level=True)
+    set_root_handlers([QueueHandler(log_queue)])
+    log_listener.start()
+    atexit.register(stop_log_queue)
+
+
+# Write what is queued and go back to direct logging
+def stop_log_queue():
+
+    global log_listener
+
+    if log_listener is None:
+        return
+
+    set_root_handlers(log_handlers)
+    log_listener.stop()
+    log_listener = None
+    atexit.unregister(stop_log_queue)
+
+
+def set_root_handlers(handlers):
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    for h in handlers:
+        root.addHandler(h)
+
+
+# a forked worker has no listener thread, it logs directly
+def drop_log_queue():
+
+    global log_listener
+
+    if log_listener is not None:
+        set_root_handlers(log_handlers)
+        log_listener = None
+
+os.register_at_fork(after_in_child=drop_log_queue)
+
+
+# Level name from the config (e.g. DEBUG for the per-symbol detail)
+def set_log_level(level_name):
+
+    level = logging.getLevelName(level_name.strip().upper())
+    if not isinstance(level, int):
+        logging.warning(f"Unknown log level: {level_name}")
+        return
+
+    logging.getLogger().setLevel(level)
+
+
+# Throttled progress for loops over symbols (or rows): every update is
+# logged at DEBUG, an INFO line with the rate and ETA at most every
+# PROGRESS_SECONDS, and a last line from finish().  total may be None
+# when it isn't known up front (no ETA then).
+class ProgressReporter:
+
+    def __init__(self, total, what="symbols", seconds=PROGRESS_SECONDS):
+        self.total = total
+        self.what = what
+        self.seconds = seconds
+        self.count = 0
+        self.start = self.last = time.perf_counter()
+
+    def update(self, n=1, detail=None):
+
+        self.count += n
+        now = time.perf_counter()
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(detail or self.line(now))
+
+        if now - self.last >= self.seconds:
+            self.last = now
+            logging.info(self.line(now))
+
+    def finish(self):
+
+        now = time.perf_counter()
+        logging.info(self.line(now, eta=False) +
+                     f" in {timedelta(seconds=round(now - self.start))}")
+
+    def line(self, now, eta=True):
+
+        done = f"[{self.count:,}" + (f" of {self.total:,}]" if self.total else "]")
+        rate = self.count / max(now - self.start, 1e-9)
+        line = f"{done} {self.what}, {rate:,.0f}/s"
+
+        if eta and self.total and rate > 0:
+            left = (self.total - self.count) / rate
+            line += f", ETA {timedelta(seconds=round(left))}"
+
+        return line
@@ -0,0 +1,91 @@
+import pandas as pd 
+import numpy as np
+import os
+from math import ceil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from lib.ntlogging import logging
+from lib.symbol_codes import symbol_keys
+
+
+# Symbols are independent in every stage, so a frame sorted by symbol is
+# cut into shards of whole symbols and the shards are run on a process
+# pool.  Results come back in shard order, so merging them keeps the
+# symbol, interval order of a serial run.  Only a few shards per worker
+# are in flight at a time, so a slow consumer (e.g. the results writer)
+# holds back the workers instead of their results piling up.
+
+SHARDS_IN_FLIGHT = 2  # per worker
+
+
+# Number of worker processes from the config (0 = one per cpu)
+def get_workers(cfg):
+
+    workers = int(cfg.get('workers', '1'))
+    if workers < 1:
+        workers = os.cpu_count() or 1
+
+    return workers
+
+
+# Split a frame sorted by symbol into slices of whole symbols
+def symbol_batches(prices_df, batch_symbols=500):
+
+    sym = symbol_keys(prices_df['symbol'])
+    starts = np.flatnonzero(sym[1:] != sym[:-1]) + 1
+    starts = np.concatenate(([0], starts))[::batch_symbols]
+    ends = np.append(starts[1:], len(sym))
+
+    return [prices_df.iloc[s:e] for s, e in zip(starts, ends) if e > s]
+
+
+# Symbols per shard: a few shards per worker to even out the load,
+# but never more than max_symbols to bound the memory of each result
+def shard_symbols(numsyms, workers, max_symbols=500):
+
+    per_shard = ceil(numsyms / (workers * 4)) if workers > 1 else max_symbols
+
+    return max(1, min(per_shard, max_symbols))
+
+
+# Shard a frame sorted by symbol for the given number of workers
+def symbol_shards(df, workers, max_symbols=500):
+
+    numsyms = df['symbol'].nunique()
+
+    return symbol_batches(df, shard_symbols(numsyms, workers, max_symbols))
+
+
+# Yield func(shard, *args) for each shard, in shard order.
+# func must be a module level function so it can be sent to the workers.
+def map_shards(func, shards, workers, *args):
+
+    if workers <= 1 or len(shards) <= 1:
+        for shard in shards:
+            yield func(shard, *args)
+        return
+
+    workers = min(workers, len(shards))
+    logging.info(f"Running {len(shards)} shards on {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        calls = ((shard,) + args for shard in shards)
+        yield from bounded_map(pool, func, calls, workers * SHARDS_IN_FLIGHT)
+
+
+# Yield func(*args) for each args tuple of calls, in order, run on the
+# pool with at most window calls submitted and not yet yielded
+def bounded_map(pool, func, calls, window):
+
+    pending = deque()
+    try:
+        for args in calls:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(pool.submit(func, *args))
+
+        while pending:
+            yield pending.popleft().result()
+
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,248 @@
+import os
+import json
+import hashlib
+from lib.ntlogging import logging
+from lib.stox_utils import *
+from lib.analyze import analysis_postfix
+from lib.metrics import StageMetrics, record_skipped
+
+
+# Stage cache for the clean -> symbols -> filter -> buy-sell -> analyze
+# pipeline (and the matrix, blacklist and benchmark runs).
+#
+# Each stage lists the files it reads and the stox.ini keys it uses (and
+# its main input and output, whose rows are counted in the metrics).  Its
+# key is a hash of those keys' values and the contents of those files.
+# When a stage runs, each artifact it writes is recorded (in
+# PIPELINE_CACHE_FILE) with the stage, its key and the artifact's content
+# hash.  A stage whose artifacts all exist, still have the recorded
+# content and were last written by it with its current key is skipped.
+# Some files are written by more than one stage (e.g. buy-sell, analyze
+# and the matrix all write analysis files), so a stage goes stale when
+# another stage (or the same one with other settings) overwrites its
+# output.  A write that leaves the content as it was keeps the earlier
+# writers current (e.g. analyze after buy-sell, which both write the
+# same analysis).  File hashes are cached by size and mtime, so unchanged
+# files are not re-read.
+#
+# Each run (or skip) is recorded in the stage metrics (lib/metrics.py).
+
+def analysis_outputs(cfg):
+    return [ANALYSIS_FILE_PREFIX + 
+            analysis_postfix(cfg['stock_hold_time'], cfg['budget_dollars'])]
+
+
+def buy_sell_outputs(cfg):
+    trade_log = [BUY_SELL_RESULTS_FILE]
+    if not cfg.getboolean('write_trade_log', fallback=True):
+        trade_log = []
+    return trade_log + analysis_outputs(cfg)
+
+
+def matrix_outputs(cfg):
+    prefixes = [ANALYSIS_FILE_PREFIX]
+    if len(get_benchmark_files(cfg)) > 0:
+        prefixes.append(BENCH_ANALYSIS_FILE_PREFIX)
+    return [f for prefix in prefixes for f in hold_budget_files(cfg, prefix)]
+
+
+def hold_budget_files(cfg, prefix):
+    holds, budgets = get_holds_budgets(cfg)
+    files = [prefix + analysis_postfix(h, b) for b in budgets for h in holds]
+    return list(dict.fromkeys(files))  # holds or budgets listed twice
+
+
+def blacklist_files(cfg, prefix):
+    holds, budgets = get_holds_budgets(cfg)
+    return [prefix + str(int(b)) + "_dollars.csv" for b in budgets]
+
+
+STAGES = {
+    'clean': {
+        'inputs': lambda cfg: [RAW_PRICES_INPUT_FILE],
+        'keys': ['rolling_sample_window', 'export_csv', 'incremental_clean'],
+        'outputs': lambda cfg: [CLEANED_PRICES_STORE, SYMBOL_CODES_FILE],
+        'rows': lambda cfg: ([], [CLEANED_PRICES_STORE])},
+    'symbols': {
+        'inputs': lambda cfg: [SUMMARY_INPUT_FILE, EARNINGS_INPUT_FILE],
+        'keys': ['date_start', 'date_end', 'symbols_limit'],
+        'outputs': lambda cfg: [SYMBOLS_FILE],
+        'rows': lambda cfg: ([SUMMARY_INPUT_FILE], [SYMBOLS_FILE])},
+    'filter': {
+        'inputs': lambda cfg: [SYMBOLS_FILE, CLEANED_PRICES_STORE],
+        'keys': ['date_start', 'date_end', 'export_csv'],
+        'outputs': lambda cfg: [FILTERED_PRICES_STORE],
+        'rows': lambda cfg: ([CLEANED_PRICES_STORE], [FILTERED_PRICES_STORE])},
+    'buysell': {
+        'inputs': lambda cfg: [FILTERED_PRICES_STORE, BENCHMARK_PRICES_FILE],
+        'keys': ['stock_hold_time', 'budget_dollars', 'tx_fee',
+                 'low_price_cutoff', 'analyze_min_trades', 'write_trade_log',
+                 'benchmark_excess'],
+        'outputs': buy_sell_outputs,
+        'rows': lambda cfg: ([FILTERED_PRICES_STORE], buy_sell_outputs(cfg)[:1])},
+    'analyze': {
+        'inputs': lambda cfg: [BUY_SELL_RESULTS_FILE],
+        'keys': ['stock_hold_time', 'budget_dollars', 'analyze_min_trades'],
+        'outputs': analysis_outputs,
+        'rows': lambda cfg: ([BUY_SELL_RESULTS_FILE], analysis_outputs(cfg))},
+    'matrix': {
+        'inputs': lambda cfg: [FILTERED_PRICES_STORE] + get_benchmark_files(cfg),
+        'keys': ['hold_times_list', 'budget_list', 'tx_fee',
+                 'low_price_cutoff', 'analyze_min_trades', 'benchmark_files',
+                 'date_start', 'date_end'],
+        'outputs': matrix_outputs,
+        'rows': lambda cfg: ([FILTERED_PRICES_STORE],
+                             hold_budget_files(cfg, ANALYSIS_FILE_PREFIX))},
+    'blacklist': {
+        'inputs': lambda cfg: hold_budget_files(cfg, ANALYSIS_FILE_PREFIX),
+        'keys': ['hold_times_list', 'budget_list'],
+        'outputs': lambda cfg: blacklist_files(cfg, BLACKLIST_FILE_PREFIX),
+        'rows': lambda cfg: (hold_budget_files(cfg, ANALYSIS_FILE_PREFIX),
+                             blacklist_files(cfg, BLACKLIST_FILE_PREFIX))},
+    'bench': {
+        'inputs': get_benchmark_files,
+        'keys': ['hold_times_list', 'budget_list', 'tx_fee',
+                 'low_price_cutoff', 'analyze_min_trades', 'benchmark_files',
+                 'date_start', 'date_end'],
+        'outputs': lambda cfg: (
+            hold_budget_files(cfg, BENCH_ANALYSIS_FILE_PREFIX) + 
+            blacklist_files(cfg, BENCH_BLACKLIST_FILE_PREFIX)),
+        'rows': lambda cfg: (get_benchmark_files(cfg),
+                             hold_budget_files(cfg, BENCH_ANALYSIS_FILE_PREFIX))},
+}
+
+
+def load_cache():
+
+    try:
+        with open(PIPELINE_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    cache.setdefault('artifacts', {})
+    cache.setdefault('digests', {})
+    # records from older caches are dropped (their stages run again)
+    cache['artifacts'] = {path: record for path, record in
+                          cache['artifacts'].items() if isinstance(record, dict)}
+
+    return cache
+
+
+def save_cache(cache):
+
+    with open(PIPELINE_CACHE_FILE, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+
+
+# Content hash of a file (cached by size and mtime)
+def file_digest(path, cache):
+
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    cached = cache['digests'].get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+
+    digest = sha.hexdigest()
+    cache['digests'][path] = [stamp, digest]
+
+    return digest
+
+
+# Content hash of a file or of every file under a directory
+def path_digest(path, cache):
+
+    if os.path.isfile(path):
+        return file_digest(path, cache)
+    if not os.path.isdir(path):
+        return "missing"
+
+    sha = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            sha.update(os.path.relpath(file_path, path).encode())
+            sha.update(file_digest(file_path, cache).encode())
+
+    return sha.hexdigest()
+
+
+def stage_key(stage, cfg, cache):
+
+    spec = STAGES[stage]
+    sha = hashlib.sha256(stage.encode())
+    for key in spec['keys']:
+        sha.update(f"{key}={cfg.get(key, '')}".encode())
+    for path in spec['inputs'](cfg):
+        sha.update(f"{path}={path_digest(path, cache)}".encode())
+
+    return sha.hexdigest()
+
+
+# True if the stage's artifacts exist and were made from its current inputs
+def is_current(stage, cfg, cache):
+
+    key = stage_key(stage, cfg, cache)
+    for path in STAGES[stage]['outputs'](cfg):
+        record = cache['artifacts'].get(path)
+        if (record is None or not os.path.exists(path) or 
+                record['writers'].get(stage) != key or
+                path_digest(path, cache) != record['digest']):
+            return False
+
+    return True
+
+
+# Record an artifact the stage just wrote: {'digest': content hash,
+# 'writers': {stage: key}}.  Earlier writers stay on it only if the
+# content is unchanged.
+def record_artifact(path, stage, key, cache):
+
+    digest = path_digest(path, cache)
+    record = cache['artifacts'].get(path)
+    if record is None or record['digest'] != digest:
+        record = {'digest': digest, 'writers': {}}
+    record['writers'][stage] = key
+    cache['artifacts'][path] = record
+
+
+# Stages that would run, in pipeline order
+def stale_stages(cfg):
+
+    cache = load_cache()
+    stale = [stage for stage in STAGES if not is_current(stage, cfg, cache)]
+    save_cache(cache)  # keep the new file digests
+
+    return stale
+
+
+# Run a stage unless its artifacts are current.  Returns True if it ran.
+def run_stage(stage, func, cfg):
+
+    spec = STAGES[stage]
+    params = {key: cfg.get(key, '') for key in spec['keys']}
+
+    cache = load_cache()
+    if is_current(stage, cfg, cache):
+        record_skipped(stage, params)
+        return False
+
+    # key from the inputs as they are when the stage starts
+    key = stage_key(stage, cfg, cache)
+    with StageMetrics(stage, params, spec['inputs'](cfg), spec['outputs'](cfg),
+                      spec['rows'](cfg)):
+        func(cfg)
+
+    cache = load_cache()
+    for path in STAGES[stage]['outputs'](cfg):
+        record_artifact(path, stage, key, cache)
+    save_cache(cache)
+
+    return True
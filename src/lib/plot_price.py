@@ -7,6 +7,8 @@ from pandas.plotting import register_matplotlib_converters
 import matplotlib.pyplot as plt
 from lib.ntlogging import logging
 from lib.stox_utils import *
+from lib.price_store import read_price_store
+from lib.trading_calendar import to_dates
 
 
 def plot_price(cfg):
@@ -22,18 +24,6 @@ def plot_price(cfg):
 
     register_matplotlib_converters()
     
-    prices_input_file = CLEANED_PRICES_FILE
-    #prices_input_file = cfg['raw_data_dir'] + cfg['raw_prices_input_file']
-    try:
-        logging.info("Reading " + prices_input_file)
-        prices_df = pd.read_table(prices_input_file, sep=',')
-        prices_df['date'] = pd.to_datetime(prices_df['date'])
-        logging.info("Prices df shape " + str(prices_df.shape))
-        
-    except Exception as e: 
-        logging.critical("Not parsed: " + prices_input_file + "\n" + str(e))
-        sys.exit()   
-
     # param string [symbol start-date end-date] 
     #   e.g. IBM 2009-01-01 2019-01-01
     symbol = param_list[0].strip()
@@ -50,16 +40,23 @@ def plot_price(cfg):
 
     date_start = pd.Timestamp(start_yr, start_mo, start_d)
     date_end = pd.Timestamp(end_yr, end_mo, end_d)
-   
 
-    # filter on date range
-    logging.info("Filtering on date range")
-    df = prices_df[(prices_df['date'] >= date_start) & (prices_df['date'] <= date_end)]
-    df = df.sort_values(['date'])
+    # read only this symbol's rows in the date range
+    prices_input_store = CLEANED_PRICES_STORE
+    try:
+        logging.info(f"Reading {symbol} from {prices_input_store}")
+        df = read_price_store(prices_input_store, symbols=[symbol],
+                              date_start=date_start, date_end=date_end)
+        logging.info("Prices df shape " + str(df.shape))
+        
+    except Exception as e: 
+        logging.critical("Not parsed: " + prices_input_store + "\n" + str(e))
+        sys.exit()   
 
-    # get group for this symbol
-    logging.info("Filtering on symbol")
-    df = df.groupby('symbol').get_group(symbol)
+    if len(df) == 0:
+        logging.warning(f"No prices for {symbol} in the plot range.")
+        return
+    df['date'] = to_dates(df['date'])
 
     # write df to file
     span_str = (date_start.strftime("%Y-%m-%d") + "_" +
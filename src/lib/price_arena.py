@@ -0,0 +1,191 @@
+import gc
+import pandas as pd
+import numpy as np
+from multiprocessing import shared_memory
+from pandas.api.types import union_categoricals
+from concurrent.futures import ProcessPoolExecutor
+from lib.ntlogging import logging
+from lib.parallel import bounded_map, SHARDS_IN_FLIGHT
+
+
+# Shared memory price arena
+#
+# A price frame (symbol, date order) is copied once into named shared
+# memory blocks: one block per numeric / date column, the symbol of each
+# row as an int32 code, the symbol names (the categories of the codes,
+# lib/symbol_codes.py), and each symbol's first row.
+# Worker processes get a small descriptor (block names, dtypes, rows)
+# instead of a pickled copy of the frame, attach to the blocks and read
+# them in place (read only views, no copies).  The process that made the
+# arena unlinks the blocks when it is closed.
+#
+#   with PriceArena([prices_df]) as arena:
+#       pool.submit(func, arena.descriptor, ...)
+#   # in the worker
+#   prices_df = attach_arena(descriptor).frame(start, end)
+
+attached = {}  # arenas attached by this process: {codes block: ArenaView}
+
+
+class PriceArena:
+
+    # frames: frames of whole symbols in symbol, date order (e.g. the
+    # shards of a frame), stored one after the other
+    def __init__(self, frames):
+
+        frames = [df for df in frames if len(df) > 0]
+        self.blocks = []
+        self.rows = sum(len(df) for df in frames)
+        columns = [c for c in frames[0].columns if c != 'symbol'] if frames else []
+
+        names, codes, first_rows = symbol_codes(frames)
+        self.descriptor = {'rows': self.rows, 'columns': {}}
+        self.descriptor['symbols'] = self.share(names)
+        self.descriptor['codes'] = self.share(codes)
+        self.descriptor['first_rows'] = self.share(first_rows)
+
+        for col in columns:
+            values = np.concatenate([df[col].to_numpy() for df in frames])
+            if values.dtype == object:
+                self.close()
+                raise ValueError(f"Price arena column {col} is not numeric")
+            self.descriptor['columns'][col] = self.share(values)
+
+        mb = sum(b.size for b in self.blocks) / 1e6
+        logging.info(f"Shared {self.rows} rows of {len(first_rows) - 1} symbols " +
+                     f"({mb:,.1f} MB)")
+
+    # copy an array to a new block, returns its (name, dtype, length)
+    def share(self, values):
+
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(values.nbytes, 1))
+        self.blocks.append(block)
+        view = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+        view[:] = values
+
+        return (block.name, values.dtype.str, len(values))
+
+    def close(self):
+
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+# Symbol names (in code order), the code of each row and the first row
+# of each symbol (plus the row count) for frames of whole symbols.
+# Frames with the same symbol categories keep their codes, others get
+# codes of the sorted union of their symbols.
+def symbol_codes(frames):
+
+    if len(frames) == 0:
+        return np.array([], dtype='U1'), np.array([], dtype=np.int32), \
+            np.zeros(1, dtype=np.int64)
+
+    sym = union_categoricals([pd.Categorical(df['symbol']) for df in frames],
+                             sort_categories=True)
+    codes = sym.codes.astype(np.int32)
+    starts = np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1))
+    names = np.asarray(sym.categories, dtype=str)
+
+    return names, codes, np.append(starts, len(codes)).astype(np.int64)
+
+
+# Read only views of an arena's blocks in a worker process
+class ArenaView:
+
+    def __init__(self, descriptor):
+
+        self.blocks = []
+        self.rows = descriptor['rows']
+        self.dtype = pd.CategoricalDtype(self.attach(descriptor['symbols']))
+        self.codes = self.attach(descriptor['codes'])
+        self.first_rows = self.attach(descriptor['first_rows'])
+        self.columns = {col: self.attach(spec)
+                        for col, spec in descriptor['columns'].items()}
+
+    def attach(self, spec):
+
+        name, dtype, length = spec
+        block = shared_memory.SharedMemory(name=name)
+        self.blocks.append(block)
+        view = np.ndarray((length,), dtype=np.dtype(dtype), buffer=block.buf)
+        view.flags.writeable = False
+
+        return view
+
+    # Frame of rows [start, end), columns are views of the blocks
+    def frame(self, start=0, end=None):
+
+        end = self.rows if end is None else end
+        data = {'symbol': pd.Categorical.from_codes(self.codes[start:end],
+                                                    dtype=self.dtype)}
+        for col, values in self.columns.items():
+            data[col] = values[start:end]
+
+        return pd.DataFrame(data, copy=False)
+
+    # Let go of the blocks (frames from frame() must be gone by then)
+    def close(self):
+
+        self.codes = self.first_rows = None
+        self.columns = {}
+        gc.collect()  # frames still in reference cycles
+        for block in self.blocks:
+            block.close()
+        self.blocks = []
+
+
+# Attach to an arena (once per process)
+def attach_arena(descriptor):
+
+    key = descriptor['codes'][0]
+    if key not in attached:
+        attached[key] = ArenaView(descriptor)
+
+    return attached[key]
+
+
+# Detach this process from an arena it is done with, so its memory is
+# freed once the arena is closed
+def detach_arena(descriptor):
+
+    view = attached.pop(descriptor['codes'][0], None)
+    if view is not None:
+        view.close()
+
+
+def run_arena_shard(func, descriptor, start, end, *args):
+
+    return func(attach_arena(descriptor).frame(start, end), *args)
+
+
+# map_shards (lib/parallel.py) for price shards: with a pool the shards
+# are put in a price arena once and the workers read them from it.
+# Yields func(shard, *args) for each shard, in shard order.
+def map_arena_shards(func, shards, workers, *args):
+
+    if workers <= 1 or len(shards) <= 1:
+        for shard in shards:
+            yield func(shard, *args)
+        return
+
+    workers = min(workers, len(shards))
+    bounds = np.cumsum([0] + [len(shard) for shard in shards])
+    with PriceArena(shards) as arena:
+
+        logging.info(f"Running {len(shards)} shards on {workers} workers")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            calls = ((func, arena.descriptor, s, e) + args
+                     for s, e in zip(bounds[:-1], bounds[1:]))
+            yield from bounded_map(pool, run_arena_shard, calls,
+                                   workers * SHARDS_IN_FLIGHT)
@@ -0,0 +1,228 @@
+import pandas as pd 
+import numpy as np
+import os
+import shutil
+from lib.ntlogging import logging
+from lib.parallel import symbol_batches
+from lib.symbol_codes import symbol_dtype, symbol_keys
+from lib.trading_calendar import to_days, day_of, day_strings, DAY_DTYPE
+
+
+# Columnar price store
+#
+# A store is a directory of parts.  Each part holds whole symbols, sorted
+# by symbol and date, as one typed .npy file per column (dates are int32
+# day ordinals, lib/trading_calendar.py).  index.csv maps each symbol to its part, its row range in
+# the part and its first and last date.  Reads push the symbol list and the
+# date window down: only the parts holding the requested symbols are
+# opened, columns are memory mapped, and each symbol's date window is found
+# by a binary search on its (sorted) dates, so only those rows are read.
+# The symbol column is read as a categorical over the symbol dictionary
+# (lib/symbol_codes.py), it is not stored.
+#
+# store/
+#     index.csv
+#     columns.txt
+#     part-00000/date.npy open.npy ... split_coefficient.npy
+#     part-00001/...
+
+INDEX_FILE = "index.csv"
+COLUMNS_FILE = "columns.txt"
+INDEX_COLS = ['symbol', 'part', 'start', 'end', 'first_date', 'last_date']
+
+
+# Writes a store from frames of whole symbols in symbol, date order.
+# The csv export is written from the finished store (export_price_store).
+class PriceStoreWriter:
+
+    def __init__(self, store_dir):
+
+        self.store_dir = store_dir
+        self.index_lst = []
+        self.columns = None
+        self.parts = 0
+
+        # replace any existing store
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.makedirs(store_dir)
+
+    def append(self, prices_df):
+
+        if len(prices_df) == 0:
+            return
+
+        part = f"part-{self.parts:05d}"
+        part_dir = os.path.join(self.store_dir, part)
+        os.makedirs(part_dir)
+
+        self.columns = [c for c in prices_df.columns if c != 'symbol']
+        dates = to_days(prices_df['date'])
+        for col in prices_df.columns:
+            if col == 'symbol':
+                continue
+            elif col == 'date':
+                values = dates
+            else:
+                values = prices_df[col].to_numpy()
+                if values.dtype == object:
+                    values = values.astype(str)
+            np.save(os.path.join(part_dir, col + ".npy"), values)
+
+        # row range of each symbol in the part
+        sym = symbol_keys(prices_df['symbol'])
+        starts = np.concatenate(([0], np.flatnonzero(sym[1:] != sym[:-1]) + 1))
+        ends = np.append(starts[1:], len(sym))
+        names = np.asarray(prices_df['symbol'].array[starts], dtype=str)
+        for name, s, e in zip(names, starts, ends):
+            self.index_lst.append([name, part, s, e, dates[s], dates[e - 1]])
+
+        self.parts += 1
+
+    # the index is written last, a store without one is incomplete
+    def close(self):
+
+        with open(os.path.join(self.store_dir, COLUMNS_FILE), 'w') as f:
+            f.write("\n".join(self.columns or []))
+
+        index_df = pd.DataFrame(self.index_lst, columns=INDEX_COLS)
+        for col in ['first_date', 'last_date']:
+            index_df[col] = day_strings(index_df[col].to_numpy(dtype=np.int64))
+        index_df.to_csv(os.path.join(self.store_dir, INDEX_FILE), index=False)
+        logging.info(f"Wrote {len(index_df)} symbols in {self.parts} parts " +
+                     f"to {self.store_dir}")
+
+
+# Write a whole frame (sorted by symbol, date) as a store, and with
+# csv_file set as a csv (spreadsheet export)
+def write_price_store(store_dir, prices_df, csv_file=None, part_symbols=500):
+
+    writer = PriceStoreWriter(store_dir)
+    for part_df in symbol_batches(prices_df, part_symbols):
+        writer.append(part_df)
+    writer.close()
+
+    if csv_file is not None:
+        prices_df.assign(date=day_strings(to_days(prices_df['date']))).to_csv(
+            csv_file, index=False, sep=",")
+
+
+# Write a store to a csv (symbol, date order) a batch of symbols at a time
+def export_price_store(store_dir, csv_file, batch_symbols=500):
+
+    symbols = np.sort(read_store_index(store_dir)['symbol'].to_numpy(dtype=str))
+    write_header = True
+    with open(csv_file, 'w') as f:
+        for b in range(0, len(symbols), batch_symbols):
+            prices_df = read_price_store(store_dir,
+                                         symbols=symbols[b:b + batch_symbols])
+            prices_df.assign(date=day_strings(prices_df['date'])).to_csv(
+                f, index=False, sep=",", header=write_header)
+            write_header = False
+
+    logging.info(f"Exported {len(symbols)} symbols of {store_dir} to {csv_file}")
+
+
+def read_store_index(store_dir):
+
+    index_file = os.path.join(store_dir, INDEX_FILE)
+    index_df = pd.read_csv(index_file, keep_default_na=False,
+                           dtype={'symbol': str, 'part': str})
+    for col in ['first_date', 'last_date']:
+        index_df[col] = to_days(index_df[col])
+
+    return index_df
+
+
+# Read a store, optionally only the given symbols, dates inside
+# [date_start, date_end] and the given columns (symbol and date always).
+# Returns a frame in symbol, date order (date as int32 day ordinals).
+def read_price_store(store_dir, symbols=None, date_start=None, date_end=None,
+                     columns=None):
+
+    index_df = read_store_index(store_dir)
+    if columns is None:
+        with open(os.path.join(store_dir, COLUMNS_FILE)) as f:
+            columns = f.read().split()
+    columns = [c for c in columns if c not in ('symbol', 'date')]
+
+    # prune symbols and symbols with no dates in the window
+    if symbols is not None:
+        index_df = index_df[index_df['symbol'].isin(symbols)]
+    if date_start is not None:
+        date_start = day_of(date_start)
+        index_df = index_df[index_df['last_date'] >= date_start]
+    if date_end is not None:
+        date_end = day_of(date_end)
+        index_df = index_df[index_df['first_date'] <= date_end]
+
+    # symbols in order, whatever order their parts were written in
+    index_df = index_df.sort_values('symbol', kind='stable')
+    dtype = symbol_dtype(index_df['symbol'])
+    index_df['code'] = dtype.categories.get_indexer(index_df['symbol'])
+
+    code_lst = []
+    rows_lst = []
+    col_lst = {col: [] for col in ['date'] + columns}
+    part_cols = {}  # memory mapped columns of each part
+    for code, part, s, e in zip(index_df['code'], index_df['part'],
+                                index_df['start'], index_df['end']):
+
+        if part not in part_cols:
+            part_dir = os.path.join(store_dir, part)
+            part_cols[part] = {col: np.load(os.path.join(part_dir, col + ".npy"),
+                                            mmap_mode='r')
+                               for col in col_lst}
+            part_cols[part]['date'] = store_days(part_cols[part]['date'])
+        values = part_cols[part]
+
+        # narrow the symbol's row range to the date window
+        if date_start is not None:
+            s += np.searchsorted(values['date'][s:e], date_start, side='left')
+        if date_end is not None:
+            e = s + np.searchsorted(values['date'][s:e], date_end, side='right')
+        if e <= s:
+            continue
+
+        code_lst.append(code)
+        rows_lst.append(e - s)
+        for col, chunks in col_lst.items():
+            chunks.append(values[col][s:e])
+
+    if len(code_lst) == 0:
+        return empty_price_frame(store_dir, columns, dtype)
+
+    codes = np.repeat(np.array(code_lst, dtype=np.int32), rows_lst)
+    prices_df = pd.DataFrame({'symbol': pd.Categorical.from_codes(codes, dtype=dtype)})
+    for col, chunks in col_lst.items():
+        prices_df[col] = np.concatenate(chunks)
+    prices_df['date'] = to_days(prices_df['date'])
+
+    return prices_df
+
+
+# Day ordinals of a stored date column (stores written before the dates
+# were day ordinals have datetime64[D], the same integers)
+def store_days(dates):
+
+    if np.issubdtype(dates.dtype, np.datetime64):
+        return dates.view(np.int64)
+
+    return dates
+
+
+# A frame with no rows and the store's column types
+def empty_price_frame(store_dir, columns, dtype):
+
+    parts = sorted(p for p in os.listdir(store_dir) if p.startswith("part-"))
+    prices_df = pd.DataFrame({'symbol': pd.Categorical([], dtype=dtype)})
+    for col in ['date'] + columns:
+        if col == 'date':
+            values = np.array([], dtype=DAY_DTYPE)
+        elif len(parts) > 0:
+            values = np.load(os.path.join(store_dir, parts[0], col + ".npy"),
+                             mmap_mode='r')[:0]
+        else:
+            values = np.array([], dtype=float)
+        prices_df[col] = values
+
+    return prices_df
@@ -4,7 +4,8 @@ import os.path
 import sys
 from datetime import datetime, timedelta
 import configparser
-from lib.ntlogging import logging
+from lib.ntlogging import logging, ProgressReporter
+from lib.trading_calendar import to_days, day_of
 from lib.filter_symbols import *
 from lib.stox_utils import *
 
@@ -45,11 +46,12 @@ def sort_symbols_by_eps(cfg):
     earn_df = load_earnings(earnings_input_file)
 
     logging.info("Filtering by date range.")
-    earn_df['date'] = pd.to_datetime(earn_df['date'])
+    earn_df = earn_df.dropna(subset=['date'])
+    earn_df['date'] = to_days(earn_df['date'])
 
     #Filter by start / end dates
-    earn_df = earn_df[(earn_df['date'] >= PRICES_START_DATE) &
-                   (earn_df['date'] <= PRICES_END_DATE)]
+    earn_df = earn_df[(earn_df['date'] >= day_of(PRICES_START_DATE)) &
+                   (earn_df['date'] <= day_of(PRICES_END_DATE))]
 
     logging.info("Filtered dates df shape " + str(earn_df.shape))
 
@@ -64,13 +66,15 @@ def sort_symbols_by_eps(cfg):
     # make df of sorted symbols
     cols = ['symbol', 'avg_eps']
     lst = []
+    progress = ProgressReporter(len(symbols_span_list), "symbols averaged")
     for symbol, symbol_grp in earn_df:
         # keep only symbols that pass the symbols listing span
         if symbol in symbols_span_list:
-            logging.info("Getting mean eps for " + symbol)
             avg_eps = symbol_grp['eps'].mean()
             lst.append([symbol, avg_eps])
-        
+            progress.update(detail="Getting mean eps for " + symbol)
+
+    progress.finish()
     symsort_df = pd.DataFrame(lst, columns=cols)
     #symsort_df = symsort_df.dropna()
     symsort_df = symsort_df.sort_values('avg_eps', ascending=False)
@@ -2,23 +2,31 @@ import pandas as pd
 import numpy as np
 import configparser
 from lib.ntlogging import logging
+from lib.trading_calendar import to_days
 
 RAW_DATA_DIR = "../data/raw/"
 STOX_DATA_DIR = "../data/stox/"
 SUMMARY_INPUT_FILE = RAW_DATA_DIR + "dataset_summary.csv"
 RAW_PRICES_INPUT_FILE = RAW_DATA_DIR + "stock_prices_latest.csv"
 EARNINGS_INPUT_FILE = RAW_DATA_DIR + "earnings_latest.csv"
+RAW_PRICES_INDEX_FILE = STOX_DATA_DIR + "stock_prices_latest_index.npz"
+CLEAN_WATERMARKS_FILE = STOX_DATA_DIR + "clean_watermarks.csv"
+PIPELINE_CACHE_FILE = STOX_DATA_DIR + "pipeline_cache.json"
+STAGE_METRICS_FILE = STOX_DATA_DIR + "stage_metrics.jsonl"
 CLEANED_PRICES_FILE = STOX_DATA_DIR + "stock_prices_cleaned.csv"
 FILTERED_PRICES_FILE = STOX_DATA_DIR + "stock_prices_filtered.csv"
+CLEANED_PRICES_STORE = STOX_DATA_DIR + "stock_prices_cleaned/"
+FILTERED_PRICES_STORE = STOX_DATA_DIR + "stock_prices_filtered/"
 SYMBOLS_FILE = STOX_DATA_DIR + "symbols.csv"
+SYMBOL_CODES_FILE = STOX_DATA_DIR + "symbol_codes.csv"
 BUY_SELL_RESULTS_FILE = STOX_DATA_DIR + "buy_sell_results.csv"
 ANALYSIS_FILE_PREFIX = STOX_DATA_DIR + "analysis_"
 BLACKLIST_FILE_PREFIX = STOX_DATA_DIR + "blacklist_"
-#BENCHMARK_PRICES_FILE = RAW_DATA_DIR + "IVV.csv"
 BENCHMARK_PRICES_FILE = RAW_DATA_DIR + "DIA.csv"
-BENCHMARK_RESULTS_FILE = STOX_DATA_DIR + "benchmarks.csv"
 BENCH_ANALYSIS_FILE_PREFIX = STOX_DATA_DIR + "bench_analysis_"
 BENCH_BLACKLIST_FILE_PREFIX = STOX_DATA_DIR + "bench_blacklist_"
+BENCH_DATA_DIR = "../data/bench/"
+SWEEP_DATA_DIR = "../data/sweeps/"
 
 
     
@@ -46,31 +54,126 @@ def save_config(config):
         logging.info("Saved " + ini_filename)
 
 
+# Round values the way they read back from a csv written with
+# float_format='%.3f'.  np.round can land on the other side of a tie, so
+# values within a hair of a tie are formatted the slow, exact way.
+def csv_round(values, decimals=3):
+
+    values = np.asarray(values, dtype=float)
+    rounded = np.round(values, decimals)
+
+    scaled = values * 10**decimals
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_tie.any():
+        rounded[near_tie] = [float(f"{v:.{decimals}f}") for v in values[near_tie]]
+
+    return rounded
+
+
+# csv export of the price stores (for spreadsheets)
+def csv_export_file(cfg, csv_file):
+
+    if cfg.getboolean('export_csv', fallback=False):
+        return csv_file
+    return None
+
+
+# hold_times_list and budget_list from the config
+def get_holds_budgets(cfg):
+
+    holds = [int(h.strip()) for h in cfg['hold_times_list'].strip().split(",")]
+    budgets = [float(b.strip()) for b in cfg['budget_list'].strip().split(",")]
+
+    return holds, budgets
+
+
+# date_start and date_end from the config (y-m-d)
+def get_date_span(cfg):
+
+    start_yr, start_mo, start_d = [int(x) for x in cfg['date_start'].split('-')]
+    end_yr, end_mo, end_d = [int(x) for x in cfg['date_end'].split('-')]
+
+    return (pd.Timestamp(start_yr, start_mo, start_d), 
+            pd.Timestamp(end_yr, end_mo, end_d))
+
+
+# Benchmark price files (in RAW_DATA_DIR) from the config
+def get_benchmark_files(cfg):
+
+    names = [f.strip() for f in cfg.get('benchmark_files', '').split(",")]
+
+    return [RAW_DATA_DIR + name for name in names if name != ""]
+
+
+# Clean the outliers of a single symbol's prices
 def clean_outliers(df, window):
 
+    return clean_outliers_frame(df, window)
+
+
+# Clean the outliers of every symbol in a frame at once.
+# The masks are computed over the whole frame and the centered rolling
+# mean/std is a grouped rolling transform on the symbol, date sorted frame.
+def clean_outliers_frame(df, window):
+
     df = df.copy()
-    df['date'] = pd.to_datetime(df['date'])
-    df = df.sort_values(['date'])
+    df['date'] = to_days(df['date'])
+    df = df.sort_values(['symbol', 'date'], kind='stable')
+    df = df.reset_index(drop=True)
 
     # drop rows with no volume & prices less than epsilon
-    eps = 0.01
-    df = df.loc[(df.open > eps) &
-                (df.close > eps) &
-                (df.high > eps) & 
-                (df.close > eps) & 
-                (df.volume > 0)].copy()
+    df = df.loc[tradable_rows(df)]
    
     #  keep everthing inside +/- 3 std deviations from mean
         # rolling price sampling window 
     window = int(window)   
     devs = 3 # std devs
 
-    #df['zscore'] = (df.close - df.close.mean())/df.close.std(ddof=0)
-    #df['zscore'] = df['zscore'].abs()
-    df['mean'] = df['close'].rolling(window, center=True).mean()
-    df['std'] = df['close'].rolling(window, center=True).std()
-    df = df[(df.close <= df['mean'] + devs * df['std']) &
-                        (df.close >= df['mean'] - devs * df['std'])]
-    df = df.drop(['mean', 'std'], axis=1)
+    rolling = df.groupby('symbol', sort=False)['close'].rolling(window, center=True)
+    mean = rolling.mean().droplevel(0)
+    std = rolling.std().droplevel(0)
+    df = df[(df.close <= mean + devs * std) &
+            (df.close >= mean - devs * std)]
 
     return df
+
+
+# Rows with volume and prices over epsilon
+def tradable_rows(df):
+
+    eps = 0.01
+    return ((df.open > eps) &
+            (df.close > eps) &
+            (df.high > eps) & 
+            (df.close > eps) & 
+            (df.volume > 0))
+
+
+# Split coefficients that print as 1 to one significant digit are no split.
+# The test is made once per distinct coefficient, not once per row.
+def split_factors(split_coeffs):
+
+    uniq, inverse = np.unique(split_coeffs, return_inverse=True)
+    is_split = np.array([f"{c:.1}" != "1e+00" for c in uniq], dtype=bool)
+
+    return np.where(is_split[inverse], split_coeffs, 1.0)
+
+
+# Cumulative product of the split factors within each symbol of a frame
+# sorted by symbol and date.  The shares owned at row j for shares bought
+# at row i (same symbol) are shares * split_index[j] / split_index[i].
+# A zero, negative or missing coefficient is bad data: it is taken as no
+# split (it would zero the product, and every later trade of the symbol
+# would get 0 / 0 shares).
+def split_factor_index(prices_df):
+
+    factors = split_factors(prices_df['split_coefficient'].to_numpy(dtype=float))
+    bad = ~(factors > 0) | np.isinf(factors)
+    if bad.any():
+        bad_syms = sorted(set(prices_df['symbol'].array[bad]))
+        logging.warning(f"{bad.sum()} split coefficients are not positive numbers, " +
+                        f"taken as no split: {bad_syms}")
+        factors = np.where(bad, 1.0, factors)
+    factors = pd.Series(factors, index=prices_df.index)
+
+    return factors.groupby(prices_df['symbol'], sort=False).cumprod().to_numpy()
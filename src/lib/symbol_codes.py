@@ -0,0 +1,78 @@
+import os
+import pandas as pd
+import numpy as np
+from lib.ntlogging import logging
+from lib.stox_utils import SYMBOL_CODES_FILE
+
+
+# Symbol dictionary
+#
+# Each ticker in the cleaned prices has a small integer code: its position
+# in the sorted list of tickers, so ordering by code is ordering by ticker.
+# clean_prices writes the dictionary (SYMBOL_CODES_FILE) with the cleaned
+# store, and the price stores are read with the symbol column as a pandas
+# Categorical over it: a code per row (int16 for up to 32k tickers) in
+# place of a string object, so grouping, sorting and filtering on symbol
+# are integer operations and frames read from any store share the codes.
+#
+# A store with tickers the dictionary doesn't have (e.g. a dictionary from
+# another clean) gets categories of its own tickers, in the same order.
+
+loaded = {}  # the dictionary read last: {file: (stamp, dtype)}
+
+
+# Write the dictionary for the given tickers
+def write_symbol_codes(symbols, codes_file=SYMBOL_CODES_FILE):
+
+    names = np.unique(np.asarray(symbols, dtype=str))
+    codes_df = pd.DataFrame({'symbol': names, 'code': np.arange(len(names))})
+    codes_df.to_csv(codes_file, index=False)
+    logging.info(f"Wrote {len(codes_df)} symbol codes to {codes_file}")
+
+
+# CategoricalDtype of the dictionary (categories in code order), None if
+# there is no dictionary
+def read_symbol_codes(codes_file=SYMBOL_CODES_FILE):
+
+    try:
+        stat = os.stat(codes_file)
+    except OSError:
+        return None
+
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    if codes_file in loaded and loaded[codes_file][0] == stamp:
+        return loaded[codes_file][1]
+
+    codes_df = pd.read_csv(codes_file, keep_default_na=False,
+                           dtype={'symbol': str})
+    codes_df = codes_df.sort_values('code')
+    dtype = pd.CategoricalDtype(codes_df['symbol'].to_numpy(dtype=str))
+    loaded.clear()
+    loaded[codes_file] = (stamp, dtype)
+
+    return dtype
+
+
+# Symbol dtype for frames of the given tickers: the dictionary's if it
+# has them all, else categories of the tickers themselves
+def symbol_dtype(symbols):
+
+    names = np.unique(np.asarray(symbols, dtype=str))
+    dtype = read_symbol_codes()
+    if dtype is not None and dtype.categories.get_indexer(names).min(initial=0) >= 0:
+        return dtype
+
+    if dtype is not None:
+        logging.debug(f"{SYMBOL_CODES_FILE} is missing symbols, using their own codes")
+
+    return pd.CategoricalDtype(names)
+
+
+# Integer (or string) key of each row's symbol: the codes of a categorical
+# symbol column, else the symbols.  Used to find where symbols change.
+def symbol_keys(symbols):
+
+    if isinstance(symbols.dtype, pd.CategoricalDtype):
+        return symbols.cat.codes.to_numpy()
+
+    return symbols.to_numpy()
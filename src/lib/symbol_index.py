@@ -0,0 +1,111 @@
+import pandas as pd 
+import numpy as np
+import os
+import io
+import mmap
+from lib.ntlogging import logging
+
+
+# Byte offset index of a prices csv by symbol
+#
+# Maps each symbol to the byte ranges of its rows in the csv, so one
+# symbol can be read from a memory map of the file without parsing the
+# rest.  A symbol whose rows are not contiguous has several ranges.  The
+# index is rebuilt when the csv's size or modification time changes.
+
+BLOCK_BYTES = 64 * 1024 * 1024  # bytes scanned per block when indexing
+
+
+# Load the index for csv_file from index_file, (re)building it if needed
+def load_symbol_index(csv_file, index_file):
+
+    stat = os.stat(csv_file)
+
+    if os.path.exists(index_file):
+        with np.load(index_file) as idx:
+            if (int(idx['file_size']) == stat.st_size and 
+                    int(idx['file_mtime']) == stat.st_mtime_ns):
+                return (idx['symbols'], idx['starts'], idx['ends'])
+        logging.info(f"{index_file} is stale, rebuilding")
+
+    symbols, starts, ends = build_symbol_index(csv_file)
+    np.savez(index_file, symbols=symbols, starts=starts, ends=ends,
+             file_size=stat.st_size, file_mtime=stat.st_mtime_ns)
+    logging.info(f"Wrote {index_file}")
+
+    return symbols, starts, ends
+
+
+# Scan a csv (symbol in the first column) for the byte range of each run
+# of rows with the same symbol.  The file is read in blocks of whole lines
+# and the symbol column of each block is parsed by pandas.
+def build_symbol_index(csv_file):
+
+    logging.info(f"Indexing symbols in {csv_file}")
+
+    sym_lst, start_lst, end_lst = [], [], []
+    with open(csv_file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+
+            pos = buf.find(b"\n") + 1  # skip the header
+            size = len(buf)
+
+            while pos < size:
+
+                # block of whole lines
+                end = buf.rfind(b"\n", pos, min(pos + BLOCK_BYTES, size)) + 1
+                if end <= pos:
+                    end = size
+                block = buf[pos:end]
+
+                line_ends = np.flatnonzero(
+                    np.frombuffer(block, dtype=np.uint8) == ord("\n")) + 1
+                if len(line_ends) == 0 or line_ends[-1] != len(block):
+                    line_ends = np.append(line_ends, len(block))
+                line_starts = np.concatenate(([0], line_ends[:-1]))
+
+                syms = pd.read_csv(io.BytesIO(block), header=None, usecols=[0],
+                                   dtype=str, keep_default_na=False,
+                                   skip_blank_lines=False)[0].to_numpy()
+
+                # runs of the same symbol
+                runs = np.concatenate(([0], np.flatnonzero(syms[1:] != syms[:-1]) + 1))
+                run_ends = np.append(runs[1:], len(syms))
+                sym_lst.append(syms[runs])
+                start_lst.append(pos + line_starts[runs])
+                end_lst.append(pos + line_ends[run_ends - 1])
+
+                pos = end
+
+    if len(sym_lst) == 0:
+        return (np.array([], dtype=str), np.array([], dtype=np.int64),
+                np.array([], dtype=np.int64))
+
+    symbols = np.concatenate(sym_lst).astype(str)
+    starts = np.concatenate(start_lst).astype(np.int64)
+    ends = np.concatenate(end_lst).astype(np.int64)
+
+    # join runs split across block boundaries
+    joined = np.concatenate(([True], (symbols[1:] != symbols[:-1]) | 
+                                     (starts[1:] != ends[:-1])))
+    ends = np.maximum.reduceat(ends, np.flatnonzero(joined))
+
+    return symbols[joined], starts[joined], ends
+
+
+# Read one symbol's rows of csv_file through its index
+def read_symbol_rows(csv_file, index_file, symbol):
+
+    symbols, starts, ends = load_symbol_index(csv_file, index_file)
+    ranges = np.flatnonzero(symbols == symbol)
+
+    with open(csv_file, 'rb') as f:
+        header = f.readline()
+        if len(ranges) == 0:
+            return pd.read_csv(io.BytesIO(header))
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            chunks = [header] + [buf[starts[k]:ends[k]].rstrip(b"\n") + b"\n"
+                                 for k in ranges]
+
+    return pd.read_csv(io.BytesIO(b"".join(chunks)))
@@ -0,0 +1,160 @@
+import pandas as pd
+import numpy as np
+import os.path
+import string
+from lib.ntlogging import logging, ProgressReporter
+from lib.stox_utils import *
+
+
+# Synthetic raw data with the schemas of the Kaggle files
+# (stock_prices_latest.csv, earnings_latest.csv, dataset_summary.csv).
+#
+# Each symbol's history comes from its own random generator seeded with
+# (seed, symbol number), so a file is the same for a seed however it is
+# written, and a smaller universe is the first symbols of a bigger one.
+# The symbols are written in batches, so memory is bounded by the batch
+# and the files can be as big as the disk allows.
+#
+# Prices are a random walk from a listing date (some symbols list after
+# the start or delist before the end).  A split divides the raw prices
+# from its date on by its coefficient, close_adjusted is the close scaled
+# back by the later splits.  Some days have no volume and some closes are
+# outliers, spikes like the ones in noisy_price_list.txt.
+
+PRICE_COLS = ['symbol', 'date', 'open', 'high', 'low', 'close',
+              'close_adjusted', 'volume', 'split_coefficient']
+EARNINGS_COLS = ['symbol', 'date', 'qtr', 'eps_est', 'eps', 'release_time']
+SUMMARY_COLS = ['symbol', 'stock_from_date', 'stock_to_date',
+                'earnings_from_date', 'earnings_to_date']
+
+SPLIT_COEFFS = [2.0, 3.0, 1.5, 0.5, 0.1]  # forward and reverse splits
+NA_NAMES = {'NA', 'NAN', 'NULL', 'NONE'}
+
+
+# Write the three files to out_dir.  split_rate and outlier_rate are per
+# symbol per year, zero_volume is the fraction of days with no volume.
+def write_synthetic(out_dir, num_symbols, date_start, date_end, seed=0,
+                    split_rate=0.05, zero_volume=0.01, outlier_rate=0.2,
+                    batch_symbols=200):
+
+    os.makedirs(out_dir, exist_ok=True)
+    files = [os.path.join(out_dir, os.path.basename(f)) for f in
+             [RAW_PRICES_INPUT_FILE, EARNINGS_INPUT_FILE, SUMMARY_INPUT_FILE]]
+    for f in files:
+        if os.path.exists(f):
+            os.remove(f)
+
+    dates = pd.bdate_range(date_start, date_end)
+    logging.info(f"Writing {num_symbols} synthetic symbols over " +
+                 f"{len(dates)} days to {out_dir}")
+
+    rows = 0
+    progress = ProgressReporter(num_symbols, "symbols written")
+    for first in range(0, num_symbols, batch_symbols):
+
+        batch = [symbol_history(k, dates, seed, split_rate, zero_volume,
+                                outlier_rate)
+                 for k in range(first, min(first + batch_symbols, num_symbols))]
+
+        write_header = (first == 0)
+        for f, k in zip(files, range(3)):
+            batch_df = pd.concat([frames[k] for frames in batch])
+            with open(f, 'a') as out:
+                batch_df.to_csv(out, index=False, header=write_header)
+
+        rows += sum(len(frames[0]) for frames in batch)
+        progress.update(len(batch), detail=f"{rows} price rows")
+
+    progress.finish()
+    logging.info(f"Wrote {rows} price rows")
+
+    return files
+
+
+# Ticker for a symbol number: A..Z, then AA..ZZ, etc.  Names pandas would
+# read as NaN (NA, NAN, ...) get a '.' suffix, like class shares (BRK.A).
+def symbol_name(k):
+
+    letters = string.ascii_uppercase
+    name = ""
+    k += 1
+    while k > 0:
+        k, r = divmod(k - 1, 26)
+        name = letters[r] + name
+
+    if name in NA_NAMES:
+        name += "."
+
+    return name
+
+
+# (prices, earnings, summary) frames of one symbol
+def symbol_history(k, dates, seed, split_rate, zero_volume, outlier_rate):
+
+    rng = np.random.default_rng([seed, k])
+    symbol = symbol_name(k)
+
+    # listed for a span of the dates
+    n = len(dates)
+    start = rng.integers(0, n // 3) if rng.random() < 0.3 else 0
+    end = n - rng.integers(0, n // 3) if rng.random() < 0.1 else n
+    days = dates[start:end]
+    n = len(days)
+    years = n / 252.0
+
+    # split adjusted price path
+    drift, vol = rng.normal(0.0002, 0.0005), rng.uniform(0.01, 0.04)
+    adjusted = rng.uniform(2.0, 300.0) * np.exp(np.cumsum(rng.normal(drift, vol, n)))
+
+    # splits: raw prices are divided by the coefficients so far
+    split_coeff = np.ones(n)
+    num_splits = rng.poisson(split_rate * years)
+    split_days = rng.integers(0, n, num_splits)
+    split_coeff[split_days] = rng.choice(SPLIT_COEFFS, num_splits)
+    splits_so_far = np.cumprod(split_coeff)
+
+    close = adjusted / splits_so_far
+
+    # open near the last close (split that day)
+    open_ = np.empty(n)
+    open_[0] = close[0]
+    open_[1:] = close[:-1] / split_coeff[1:]
+    open_ *= np.exp(rng.normal(0.0, vol / 2.0, n))
+    high = np.maximum(open_, close) * np.exp(np.abs(rng.normal(0.0, vol / 2.0, n)))
+    low = np.minimum(open_, close) * np.exp(-np.abs(rng.normal(0.0, vol / 2.0, n)))
+
+    # close_adjusted (back adjusted by the splits after each day)
+    close_adjusted = close * splits_so_far / splits_so_far[-1]
+
+    volume = rng.lognormal(11.0, 1.5, n).astype(np.int64)
+    volume[rng.random(n) < zero_volume] = 0
+
+    # one day price spikes (up or down by about 10x)
+    num_outliers = rng.poisson(outlier_rate * years)
+    outlier_days = rng.integers(0, n, num_outliers)
+    spike = rng.uniform(8.0, 15.0, num_outliers)
+    close[outlier_days] *= np.where(rng.random(num_outliers) < 0.8, spike, 1 / spike)
+
+    date_str = days.strftime('%Y-%m-%d')
+    prices_df = pd.DataFrame({
+        'symbol': symbol, 'date': date_str,
+        'open': open_.round(4), 'high': high.round(4), 'low': low.round(4),
+        'close': close.round(4), 'close_adjusted': close_adjusted.round(6),
+        'volume': volume, 'split_coefficient': split_coeff})
+
+    # quarterly earnings
+    qtr_days = days[rng.integers(0, 63)::63]
+    eps_est = rng.normal(1.0, 1.0) + rng.normal(0.0, 0.2, len(qtr_days)).cumsum()
+    earnings_df = pd.DataFrame({
+        'symbol': symbol, 'date': qtr_days.strftime('%Y-%m-%d'),
+        'qtr': (qtr_days - pd.DateOffset(months=1)).strftime('%m/%Y'),
+        'eps_est': eps_est.round(2),
+        'eps': (eps_est + rng.normal(0.0, 0.1, len(qtr_days))).round(2),
+        'release_time': rng.choice(['pre', 'post'], len(qtr_days))})
+
+    summary_df = pd.DataFrame([[symbol, date_str[0], date_str[-1],
+                                earnings_df['date'].min(),
+                                earnings_df['date'].max()]],
+                              columns=SUMMARY_COLS)
+
+    return prices_df[PRICE_COLS], earnings_df[EARNINGS_COLS], summary_df
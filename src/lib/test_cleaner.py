@@ -7,6 +7,8 @@ from pandas.plotting import register_matplotlib_converters
 import matplotlib.pyplot as plt
 from lib.ntlogging import logging
 from lib.stox_utils import *
+from lib.symbol_index import read_symbol_rows
+from lib.trading_calendar import to_days, day_of, to_dates, day_strings
 
 
 
@@ -74,44 +76,32 @@ def test_cleaner(cfg):
     date_start = pd.Timestamp(start_yr, start_mo, start_d)
     date_end = pd.Timestamp(end_yr, end_mo, end_d)
 
-    # use group file if exists else use raw file
-    raw_symbol_file = STOX_DATA_DIR + symbol + "_raw.csv"
-
-    if os.path.exists(raw_symbol_file):
-        prices_input_file = raw_symbol_file
-    else:
-        prices_input_file = RAW_PRICES_INPUT_FILE
-
+    # read only this symbol's rows of the raw file through the symbol index
+    prices_input_file = RAW_PRICES_INPUT_FILE
     try:
-        logging.info("Reading " + prices_input_file)
-        prices_df = pd.read_table(prices_input_file, sep=',')
-        prices_df['date'] = pd.to_datetime(prices_df['date'])
-        logging.info("Prices df shape " + str(prices_df.shape))
+        logging.info(f"Reading {symbol} from {prices_input_file}")
+        df = read_symbol_rows(prices_input_file, RAW_PRICES_INDEX_FILE, symbol)
+        df['date'] = to_days(df['date'])
+        logging.info("Prices df shape " + str(df.shape))
         
     except Exception as e: 
         logging.critical("Not parsed: " + prices_input_file + "\n" + str(e))
         sys.exit()   
 
-
-     # get group for this symbol
-    logging.info("Filtering on symbol")
-    df = prices_df.groupby('symbol').get_group(symbol)
- 
-    # write the raw file for this symbol (all time frames)
-    if not os.path.exists(raw_symbol_file):
-        logging.info(f"Writing raw file for {symbol}")
-        df.to_csv(raw_symbol_file, index=False, sep=",", float_format='%.3f')
+    if len(df) == 0:
+        logging.warning(f"No prices for {symbol} in {prices_input_file}")
+        return
 
     # filter on date range
     logging.info("Filtering on date range")
-    df = df[(df['date'] >= date_start) & (df['date'] <= date_end)]
+    df = df[(df['date'] >= day_of(date_start)) & (df['date'] <= day_of(date_end))]
     df = df.sort_values(['date'])
 
     # write raw df to file
     span_str = (date_start.strftime("%Y-%m-%d") + "_" +
         date_end.strftime("%Y-%m-%d"))
     csv_name = STOX_DATA_DIR + symbol + "_" + span_str + "_raw.csv"
-    df.to_csv(csv_name, index=False, sep="\t", float_format='%.3f')
+    df.assign(date=day_strings(df['date'])).to_csv(csv_name, index=False, sep="\t", float_format='%.3f')
 
 
     # test cleaner
@@ -121,7 +111,7 @@ def test_cleaner(cfg):
     span_str = (date_start.strftime("%Y-%m-%d") + "_" +
         date_end.strftime("%Y-%m-%d"))
     csv_name = STOX_DATA_DIR + symbol + "_" + span_str + "_cleantest.csv"
-    cdf.to_csv(csv_name, index=False, sep="\t", float_format='%.3f')
+    cdf.assign(date=day_strings(cdf['date'])).to_csv(csv_name, index=False, sep="\t", float_format='%.3f')
 
 
     # PLOT
@@ -129,10 +119,10 @@ def test_cleaner(cfg):
     plt.suptitle(symbol, fontsize=10)
 
     axs[0].set_title('Raw', {'fontsize': 10})
-    axs[0].scatter(df['date'].tolist(), df['close'], color = 'blue', s=2)
+    axs[0].scatter(to_dates(df['date']), df['close'], color = 'blue', s=2)
 
     axs[1].set_title('Cleaned', {'fontsize': 10})
-    axs[1].scatter(cdf['date'].tolist(), cdf['close'], color = 'green', s=2)
+    axs[1].scatter(to_dates(cdf['date']), cdf['close'], color = 'green', s=2)
 
 
     plt_filename = STOX_DATA_DIR + symbol + "_" + span_str + ".png"
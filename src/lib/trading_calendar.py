@@ -0,0 +1,89 @@
+import pandas as pd
+import numpy as np
+
+
+# Dates as integers
+#
+# Dates go through the pipeline as int32 day ordinals (days since
+# 1970-01-01, the integer behind datetime64[D]).  They are parsed once
+# where they come in (raw csv files, the config) and turned back into
+# 'YYYY-MM-DD' strings only where they are written out.  Calendar days
+# between two dates are a subtraction, and a TradingCalendar maps days to
+# trading day indices, so trading days between two dates are one too
+# (the difference of their indices).
+#
+# Strings are parsed once per distinct value (a price file repeats the
+# same few thousand dates on every symbol).
+
+DAY_DTYPE = np.int32
+
+
+# Day ordinals of dates (strings, datetimes or day ordinals)
+def to_days(values):
+
+    values = np.asarray(values)
+
+    if np.issubdtype(values.dtype, np.integer):
+        return values.astype(DAY_DTYPE, copy=False)
+
+    if np.issubdtype(values.dtype, np.datetime64):
+        if np.isnat(values).any():
+            raise ValueError("missing dates")
+        return values.astype('datetime64[D]').astype(np.int64).astype(DAY_DTYPE)
+
+    codes, uniq = pd.factorize(values)
+    if (codes < 0).any():
+        raise ValueError("missing dates")
+    uniq_days = to_days(pd.to_datetime(uniq).to_numpy())
+
+    return uniq_days[codes]
+
+
+# Day ordinal of one date (string, datetime or Timestamp)
+def day_of(value):
+
+    return int(np.datetime64(pd.Timestamp(value), 'D').astype(np.int64))
+
+
+# datetime64[D] of day ordinals (e.g. for plotting)
+def to_dates(days):
+
+    return np.asarray(days).astype(np.int64).astype('datetime64[D]')
+
+
+# 'YYYY-MM-DD' strings of day ordinals for output (None where a float
+# array has NaN, written as an empty field)
+def day_strings(days):
+
+    days = np.asarray(days)
+    missing = np.isnan(days) if np.issubdtype(days.dtype, np.floating) else None
+    if missing is not None:
+        days = np.where(missing, 0, days)
+
+    uniq, inverse = np.unique(days.astype(np.int64), return_inverse=True)
+    strings = np.datetime_as_string(uniq.astype('datetime64[D]')).astype(object)
+    out = strings[inverse.reshape(-1)]
+    if missing is not None:
+        out[missing] = None
+
+    return out
+
+
+# Day ordinals of the config's date_start and date_end
+def config_days(cfg):
+
+    return day_of(cfg['date_start']), day_of(cfg['date_end'])
+
+
+# The trading days (sorted distinct day ordinals) of a price series
+class TradingCalendar:
+
+    def __init__(self, days):
+        self.days = np.unique(to_days(days))
+
+    # Trading day index of each day: its position if it is a trading day,
+    # else that of the last trading day before it (-1 before the first)
+    def index(self, days):
+
+        return (np.searchsorted(self.days, to_days(days), side='right') - 1
+                ).astype(DAY_DTYPE)
@@ -0,0 +1,46 @@
+import sys
+import argparse
+from lib.ntlogging import logging, start_log_queue
+from lib.stox_utils import *
+from lib.synthetic import write_synthetic
+
+
+# Write synthetic stock_prices_latest.csv, earnings_latest.csv and
+# dataset_summary.csv (Kaggle schemas) for tests and benchmarks, e.g.
+#
+#   python make_synthetic.py --symbols 7000 --out-dir ../data/synthetic/raw/
+#
+# The files are the same for the same seed and settings.
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(description="Synthetic raw price data")
+    parser.add_argument('--out-dir', default=BENCH_DATA_DIR + "raw/",
+                        help="output dir (not the real raw data dir)")
+    parser.add_argument('--symbols', type=int, default=100)
+    parser.add_argument('--start', default="1998-01-02")
+    parser.add_argument('--end', default="2019-08-09")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--split-rate', type=float, default=0.05,
+                        help="splits per symbol per year")
+    parser.add_argument('--zero-volume', type=float, default=0.01,
+                        help="fraction of days with no volume")
+    parser.add_argument('--outlier-rate', type=float, default=0.2,
+                        help="price outliers per symbol per year")
+
+    return parser.parse_args()
+
+
+def main():
+
+    args = parse_args()
+    start_log_queue()
+    write_synthetic(args.out_dir, args.symbols, args.start, args.end,
+                    seed=args.seed, split_rate=args.split_rate,
+                    zero_volume=args.zero_volume,
+                    outlier_rate=args.outlier_rate)
+
+
+if __name__ == '__main__':
+    main()
+    print("DONE\n")
@@ -3,14 +3,18 @@ import numpy as np
 import os.path
 import sys
 import configparser
+import argparse
 from math import floor
 from datetime import datetime, timedelta
-from lib.ntlogging import logging
+from lib.ntlogging import (logging, start_log_queue, stop_log_queue,
+    set_log_level, LOG_FILE, LOG_BACKUPS)
 import pathlib
+import shutil
 from pathlib import Path
 from lib.filter_symbols import *
 from lib.filter_prices import *
 from lib.buy_sell_v3 import *
+from lib.buy_sell_matrix import *
 from lib.sort_symbols_by_eps import *
 from lib.stox_utils import *
 from lib.analyze import *
@@ -19,6 +23,8 @@ from lib.clean_prices import *
 from lib.test_cleaner import *
 from lib.make_blacklist import *
 from lib.run_benchmarks import *
+from lib.pipeline import run_stage, stale_stages
+import lib.metrics
 
 
 def get_symbol_file_rows(cfg):
@@ -34,59 +40,37 @@ def get_symbol_file_rows(cfg):
 
 def write_symbols(cfg):
     logging.info("Running symbols filter...")
-    sort_symbols_by_eps(cfg)
-    input("OK >")
+    run_stage('symbols', sort_symbols_by_eps, cfg)
 
 
 def run_prices_filter(cfg):
     logging.info("Running prices filter...")
-    filter_prices(cfg)
-    input("OK >")
+    run_stage('filter', filter_prices, cfg)
 
 
 def run_buy_sell(cfg):
     logging.info("Running buy-sell...")
-    buy_sell_v3(cfg)
-    input("OK >")
+    run_stage('buysell', buy_sell_v3, cfg)
 
 
 def rm_stoxdir(cfg):
     stox_dir = STOX_DATA_DIR
-    for p in Path(stox_dir).glob("*.*"):
-        p.unlink()
+    for p in Path(stox_dir).glob("*"):
+        if p.is_dir():
+            shutil.rmtree(p)
+        else:
+            p.unlink()
     logging.info("Removed stox data.")
-    input("OK >")
 
 
 def run_analysis(cfg):
     logging.info("Running analysis...")
-    analyze(cfg)
-    input("OK >")
+    run_stage('analyze', analyze, cfg)
 
 
 def run_buy_sell_analyze(cfg):
-
-    holds_cfg = cfg['hold_times_list'].strip()
-    budget_cfg = cfg['budget_list'].strip()
-
-    holds_lst = holds_cfg.split(",")
-    budget_lst = budget_cfg.split(",")
-
-    for budget in budget_lst:
-        b = float(budget.strip())
-
-        for hold in holds_lst:
-            h = int(hold.strip())
-
-            cfg['stock_hold_time'] = str(h)
-            cfg['budget_dollars'] = str(b)
-
-            logging.info(f"Running buy-sell with {h} days and {b} dollars...")
-            buy_sell_v3(cfg)
-            logging.info("Running analyze with {h} days and {b} dollars...")
-            analyze(cfg)
-
-    input("OK > ")
+    logging.info("Running buy-sell + analyze matrix...")
+    run_stage('matrix', buy_sell_matrix, cfg)
 
 
 def run_price_plot(cfg):
@@ -96,8 +80,7 @@ def run_price_plot(cfg):
 
 def run_clean_prices(cfg):
     logging.info(f"Cleaning with window = {cfg['rolling_sample_window']}")
-    clean_prices(cfg)
-    input("OK >")
+    run_stage('clean', clean_prices, cfg)
 
 
 def run_cleaner_test(cfg):
@@ -107,15 +90,38 @@ def run_cleaner_test(cfg):
 
 def run_make_blacklist(cfg):
     logging.info("Running blacklist...")
-    make_blacklist(cfg)
-    input("OK >")
+    run_stage('blacklist', make_blacklist, cfg)
+
 
 def run_bench(cfg):
     logging.info("Running benchmarks...")
-    run_benchmarks(cfg)
-    input("OK >")
+    run_stage('bench', run_benchmarks, cfg)
+
+
+# Commands by cli name, and the menu reply for each
+COMMANDS = {
+    'rmdata': rm_stoxdir,
+    'clean': run_clean_prices,
+    'symbols': write_symbols,
+    'filter': run_prices_filter,
+    'buysell': run_buy_sell,
+    'analyze': run_analysis,
+    'plot': run_price_plot,
+    'cleantest': run_cleaner_test,
+    'matrix': run_buy_sell_analyze,
+    'blacklist': run_make_blacklist,
+    'bench': run_bench}
 
+MENU_REPLIES = {'1': 'rmdata', '2': 'clean', '3': 'symbols', '4': 'filter',
+                '5': 'buysell', '6': 'analyze', '7': 'plot', '8': 'cleantest',
+                '9': 'matrix', '10': 'blacklist', '11': 'bench'}
 
+# Stages run by "stox.py run all"
+PIPELINE = ['clean', 'symbols', 'filter', 'buysell', 'analyze']
+
+# Exit status of the cli
+EXIT_OK = 0
+EXIT_FAILED = 1  # a command failed (bad arguments exit with 2)
 
 
 def main():
@@ -124,6 +130,17 @@ def main():
     stox_dir = STOX_DATA_DIR
     pathlib.Path(stox_dir).mkdir(exist_ok=True)
 
+    start_log_queue()
+
+    if len(sys.argv) > 1:
+        return run_cli(sys.argv[1:])
+
+    run_menu()
+    return EXIT_OK
+
+
+def run_menu():
+
     reply = "none"
     while reply != "q":
 
@@ -131,44 +148,105 @@ def main():
         reply, cfg = show_menu(reply)
 
         if reply == '0':
+            stop_log_queue()
             logging.shutdown()
-            if os.path.exists("log-stox.log"):
-                os.remove("log-stox.log")
+            for log_file in [LOG_FILE] + [f"{LOG_FILE}.{n}" for n in
+                                          range(1, LOG_BACKUPS + 1)]:
+                if os.path.exists(log_file):
+                    os.remove(log_file)
+            start_log_queue()
             logging.info("Log deleted.")
             input("OK >")
 
-        elif reply == '1':
-            rm_stoxdir(cfg)
+        elif reply in MENU_REPLIES:
+            command = MENU_REPLIES[reply]
+            COMMANDS[command](cfg)
+            if command not in ['plot', 'cleantest']:
+                input("OK >")
+
+
+# Non-interactive commands:
+#   stox.py <command> [--set key=value ...]
+#   stox.py run <command,command,...|all> [--set key=value ...]
+#   stox.py stale [--set key=value ...]
+# The overrides apply to this run only (stox.ini is not changed).  A
+# pipeline runs its commands in order in this process and stops at the
+# first one that fails.
+def run_cli(argv):
+
+    parser = cli_parser()
+    args = parser.parse_args(argv)
+
+    cfg = load_config()['stox']
+    for override in args.set:
+        key, sep, value = override.partition("=")
+        key = key.strip()
+        if sep == "" or key not in cfg:
+            parser.error(f"bad override {override} (expected a stox.ini key=value)")
+        cfg[key] = value.strip()
+    set_log_level(args.log_level or cfg.get('log_level', 'INFO'))
+
+    if args.command == 'stale':
+        print("\n".join(stale_stages(cfg)) or "none")
+        return EXIT_OK
+
+    if args.command == 'run':
+        commands = PIPELINE if args.spec == 'all' else \
+            [c.strip() for c in args.spec.split(",") if c.strip()]
+        unknown = [c for c in commands if c not in COMMANDS]
+        if len(commands) == 0 or len(unknown) > 0:
+            parser.error(f"bad pipeline {args.spec} (commands: " +
+                         ", ".join(COMMANDS) + ")")
+    else:
+        commands = [args.command]
+
+    # the filtered prices are read once when several commands use them
+    if len(commands) > 1:
+        keep_loaded_prices()
+
+    for command in commands:
+        if not run_command(command, cfg):
+            logging.critical(f"{command} failed, stopping.")
+            return EXIT_FAILED
 
-        elif reply == "2":
-            run_clean_prices(cfg)
+    return EXIT_OK
 
-        elif reply == "3":
-            write_symbols(cfg)
 
-        elif reply == "4":
-            run_prices_filter(cfg)
+def cli_parser():
 
-        elif reply == "5":
-            run_buy_sell(cfg)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE', help="override a stox.ini value")
+    common.add_argument('--log-level', help="log level for this run")
 
-        elif reply == "6":
-            run_analysis(cfg)
+    parser = argparse.ArgumentParser(
+        prog="stox.py", description="Run stox commands without the menu.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for command in COMMANDS:
+        commands.add_parser(command, parents=[common])
+    run = commands.add_parser('run', parents=[common],
+                              help="run commands in order, e.g. " +
+                              "clean,symbols,filter or all")
+    run.add_argument('spec')
+    commands.add_parser('stale', parents=[common],
+                        help="list the stages that are not up to date")
 
-        elif reply == "7":
-            run_price_plot(cfg)
+    return parser
 
-        elif reply == "8":
-            run_cleaner_test(cfg)
 
-        elif reply == "9":
-            run_buy_sell_analyze(cfg)
+# Run a command, True if it succeeded.  Errors end the stages with
+# sys.exit(), so any exit from a command counts as a failure.
+def run_command(command, cfg):
 
-        elif reply == "10":
-            run_make_blacklist(cfg)
+    try:
+        COMMANDS[command](cfg)
+    except SystemExit:
+        return False
+    except Exception as e:
+        logging.critical(f"{command}: {type(e).__name__}: {e}")
+        return False
 
-        elif reply == "11":
-            run_bench(cfg)
+    return True
 
 
 # Kaggle:
@@ -178,6 +256,7 @@ def show_menu(previous):
 
     config = load_config()
     cfg = config['stox']
+    set_log_level(cfg.get('log_level', 'INFO'))
     # update_symbol_count(cfg)
     num_symbols = get_symbol_file_rows(cfg)
 
@@ -193,7 +272,8 @@ def show_menu(previous):
     prompt += f"\nrolling window {cfg['rolling_sample_window']}"
 
     prompt += ("\nSymbols in current symbol file: " + 
-                str(num_symbols) + "\n")
+                str(num_symbols))
+    prompt += "\nStale stages: " + (", ".join(stale_stages(cfg)) or "none") + "\n"
 
     prompt += "\nCommands:"           
     prompt += "\n0) Delete the log"
@@ -210,6 +290,8 @@ def show_menu(previous):
     prompt += "\n11) Run benchmarks"
     prompt += "\nq) Quit"
     prompt += "\nLast command was: " + str(previous)
+    if lib.metrics.last_summary is not None:
+        prompt += "\nLast stage: " + lib.metrics.last_summary
     prompt += "\nstox > "
     reply = input(prompt)
 
@@ -217,5 +299,6 @@ def show_menu(previous):
 
 
 if __name__ == '__main__':
-    main()
-    print("DONE\n")
\ No newline at end of file
+    status = main()
+    print("DONE\n")
+    sys.exit(status)
\ No newline at end of file
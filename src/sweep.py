@@ -0,0 +1,402 @@
+import pandas as pd
+import os.path
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import itertools
+import configparser
+import multiprocessing
+from concurrent.futures import (ProcessPoolExecutor, as_completed, wait,
+                                FIRST_COMPLETED)
+from datetime import datetime
+from lib.ntlogging import logging, start_log_queue, ProgressReporter
+from lib.stox_utils import *
+from lib.parallel import get_workers
+from lib.analyze import analysis_postfix
+from lib.buy_sell_v3 import (buy_sell_v3, load_sim_prices, use_loaded_prices,
+                             clear_loaded_prices)
+from lib.price_arena import PriceArena, attach_arena, detach_arena
+from lib.sort_symbols_by_eps import sort_symbols_by_eps
+from lib.filter_prices import filter_prices
+from lib.pipeline import STAGES, run_stage
+from lib.metrics import StageMetrics
+
+
+# Parameter sweeps: buy-sell + analysis for every cell of a grid, e.g.
+#
+#   python sweep.py --name holds --grid stock_hold_time=4,9,14,30 \
+#       --grid budget_dollars=1000,5000 --grid date_start=2009-1-1,2014-1-1
+#
+# Each cell (job) runs with its own config (stox.ini plus the --set
+# overrides plus the cell's values) in its own tree under
+# SWEEP_DATA_DIR/<name>/jobs/<job>/, so sweeps and jobs don't share any
+# output file.  Jobs run on a pool of worker processes (--workers, one
+# worker each inside a job).
+#
+# The symbols and filtered prices depend only on the date span, so they
+# are made once per span (spans/<span>/, from the cleaned prices) and
+# linked into the jobs of that span.  Each span's prices are loaded once
+# into a shared memory price arena (lib/price_arena.py) that its jobs
+# read instead of loading the prices again.  The arenas are made span by
+# span as the jobs get to them, at most SPAN_ARENAS at a time, and each
+# job lets go of its span's arena when it ends.
+#
+# Each finished job is appended to manifest.jsonl.  A job is named by a
+# hash of its config, so running the same sweep again skips the jobs that
+# are done and an interrupted sweep carries on where it stopped.  At the
+# end the analysis of every done job is collected, with the job's grid
+# values, in analysis.csv.
+
+SWEEP_KEYS = ['stock_hold_time', 'budget_dollars', 'date_start', 'date_end',
+              'low_price_cutoff', 'tx_fee']
+SPAN_KEYS = sorted(set(STAGES['symbols']['keys'] + STAGES['filter']['keys']))
+MANIFEST_FILE = "manifest.jsonl"
+SWEEP_ANALYSIS_FILE = "analysis.csv"
+SPAN_ARENAS = 2  # span arenas in shared memory at once
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(description="Resumable parameter sweeps")
+    parser.add_argument('--name', required=True, help="sweep name (its dir)")
+    parser.add_argument('--grid', action='append', default=[],
+                        metavar='KEY=V1,V2,...',
+                        help="values of a key, one of: " + ", ".join(SWEEP_KEYS))
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE', help="override a stox.ini value")
+    parser.add_argument('--workers', type=int,
+                        help="jobs at a time (default: workers in stox.ini)")
+
+    return parser.parse_args()
+
+
+def main():
+
+    args = parse_args()
+    start_log_queue()
+
+    cfg = dict(load_config()['stox'])
+    for override in args.set:
+        key, value = parse_pair(override, cfg)
+        cfg[key] = value
+
+    grid = {}
+    for axis in args.grid:
+        key, values = parse_pair(axis, SWEEP_KEYS)
+        grid[key] = [v.strip() for v in values.split(",") if v.strip() != ""]
+
+    if not os.path.isdir(CLEANED_PRICES_STORE):
+        logging.critical(f"No cleaned prices ({CLEANED_PRICES_STORE}), " +
+                         "run the clean step first.")
+        return 1
+
+    sweep_dir = os.path.abspath(SWEEP_DATA_DIR + args.name)
+    os.makedirs(sweep_dir, exist_ok=True)
+    workers = args.workers or get_workers(load_config()['stox'])
+
+    jobs = grid_jobs(cfg, grid)
+    done = load_manifest(sweep_dir)
+    todo = [job for job in jobs if job['job'] not in done]
+    logging.info(f"Sweep {args.name}: {len(jobs)} jobs, " +
+                 f"{len(jobs) - len(todo)} done, {len(todo)} to run " +
+                 f"on {workers} workers")
+
+    failed = run_jobs(sweep_dir, todo, workers)
+
+    done = load_manifest(sweep_dir)
+    collect_analysis(sweep_dir, [job for job in jobs if job['job'] in done])
+
+    return 1 if failed > 0 else 0
+
+
+# "key=value" with a known key, as (key, value)
+def parse_pair(text, keys):
+
+    key, sep, value = text.partition("=")
+    key = key.strip()
+    if sep == "" or key not in keys:
+        logging.critical(f"Bad argument {text} (expected key=value)")
+        sys.exit(2)
+
+    return key, value.strip()
+
+
+# A job for each cell of the grid (spans that end before they start are
+# left out): {'job': id, 'span': span id, 'params': grid values,
+# 'cfg': full config}
+def grid_jobs(cfg, grid):
+
+    jobs = []
+    keys = list(grid)
+    for values in itertools.product(*[grid[k] for k in keys]):
+
+        params = dict(zip(keys, values))
+        job_cfg = dict(cfg, **params)
+        job_cfg['workers'] = '1'  # the sweep runs the jobs in parallel
+        job_cfg['export_csv'] = 'no'
+
+        date_start, date_end = get_date_span(job_cfg)
+        if date_start >= date_end:
+            logging.warning(f"Skipping {params}: empty date span")
+            continue
+
+        jobs.append({'job': config_id(job_cfg),
+                     'span': config_id({k: job_cfg[k] for k in SPAN_KEYS}),
+                     'params': params, 'cfg': job_cfg})
+
+    return jobs
+
+
+def config_id(cfg):
+
+    text = json.dumps(cfg, sort_keys=True)
+
+    return hashlib.sha256(text.encode()).hexdigest()[:12]
+
+
+# Jobs recorded as done in the manifest: {job id: record}
+def load_manifest(sweep_dir):
+
+    done = {}
+    manifest_file = os.path.join(sweep_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return done
+
+    with open(manifest_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by an interrupt
+            if record['status'] == 'ok':
+                done[record['job']] = record
+            else:
+                done.pop(record['job'], None)
+
+    return done
+
+
+def append_manifest(sweep_dir, record):
+
+    with open(os.path.join(sweep_dir, MANIFEST_FILE), 'a') as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# Make the spans, then run the jobs whose span was made.  Returns the
+# number of failed jobs and spans.
+def run_jobs(sweep_dir, jobs, workers):
+
+    if len(jobs) == 0:
+        return 0
+
+    raw_dir = os.path.abspath(RAW_DATA_DIR)
+    cleaned = [os.path.abspath(path) for path in
+               [CLEANED_PRICES_STORE, SYMBOL_CODES_FILE]]
+    spans = {job['span']: job['cfg'] for job in jobs}
+    failed = 0
+
+    # spawned workers, each job sets its own working dir
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+
+        futures = {pool.submit(make_span, span_dir(sweep_dir, span), span_cfg,
+                               raw_dir, cleaned): span
+                   for span, span_cfg in spans.items()}
+        made = set()
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                logging.critical(f"Span {futures[future]} failed: " +
+                                 f"{future.exception()!r}")
+                failed += 1
+            else:
+                made.add(futures[future])
+
+        made_jobs = [job for job in jobs if job['span'] in made]
+        failed += run_span_jobs(pool, sweep_dir, made_jobs, raw_dir)
+
+    return failed
+
+
+# Run the jobs span by span, record them in the manifest.  A span's arena
+# is made when its jobs are next and closed when its last job is done,
+# with at most SPAN_ARENAS alive at once (the next span's jobs are queued
+# while the last ones of the span before run).  Returns the number of
+# failed jobs.
+def run_span_jobs(pool, sweep_dir, jobs, raw_dir):
+
+    failed = 0
+    span_jobs = {}  # {span: jobs}, spans in the order of their first job
+    for job in jobs:
+        span_jobs.setdefault(job['span'], []).append(job)
+    waiting = list(span_jobs)
+    left = {span: len(span_jobs[span]) for span in span_jobs}
+    arenas = {}
+    futures = {}
+
+    progress = ProgressReporter(len(jobs), "jobs", seconds=0)
+    try:
+        while waiting or futures:
+
+            while waiting and len(arenas) < SPAN_ARENAS:
+                span = waiting.pop(0)
+                arenas[span] = span_arena(span_dir(sweep_dir, span))
+                for job in span_jobs[span]:
+                    futures[pool.submit(run_job, job_dir(sweep_dir, job['job']),
+                                        job['cfg'], raw_dir,
+                                        span_dir(sweep_dir, span),
+                                        arenas[span].descriptor)] = job
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+
+                job = futures.pop(future)
+                left[job['span']] -= 1
+                if left[job['span']] == 0:
+                    arenas.pop(job['span']).close()
+
+                record = {'job': job['job'], 'params': job['params'],
+                          'end': datetime.now().isoformat(timespec='seconds')}
+                if future.exception() is not None:
+                    logging.critical(f"Job {job['job']} {job['params']} failed: " +
+                                     f"{future.exception()!r}")
+                    record['status'] = 'failed'
+                    failed += 1
+                else:
+                    record['status'] = 'ok'
+                    record['seconds'], record['rows'] = future.result()
+
+                append_manifest(sweep_dir, record)
+                progress.update(detail=f"{job['job']} {job['params']}")
+
+    finally:
+        for arena in arenas.values():
+            arena.close()
+
+    progress.finish()
+
+    return failed
+
+
+def span_dir(sweep_dir, span):
+    return os.path.join(sweep_dir, "spans", span)
+
+
+def job_dir(sweep_dir, job):
+    return os.path.join(sweep_dir, "jobs", job)
+
+
+# Tree for a stage run in base_dir: data/raw linked to the raw data,
+# data/stox/ and src/ (the working dir) with the run's stox.ini.
+def make_tree(base_dir, cfg, raw_dir):
+
+    src_dir = os.path.join(base_dir, "src")
+    stox_dir = os.path.join(base_dir, "data", "stox")
+    os.makedirs(src_dir, exist_ok=True)
+    os.makedirs(stox_dir, exist_ok=True)
+
+    raw_link = os.path.join(base_dir, "data", "raw")
+    if not os.path.islink(raw_link):
+        os.symlink(raw_dir, raw_link)
+
+    config = configparser.ConfigParser()
+    config['stox'] = cfg
+    with open(os.path.join(src_dir, "stox.ini"), 'w') as f:
+        config.write(f)
+
+    return src_dir, stox_dir
+
+
+# Symbols and filtered prices for a date span (stages skipped if current),
+# from the cleaned store and symbol dictionary linked in
+def make_span(base_dir, cfg, raw_dir, cleaned):
+
+    src_dir, stox_dir = make_tree(base_dir, cfg, raw_dir)
+    for path in cleaned:
+        cleaned_link = os.path.join(stox_dir, os.path.basename(
+            os.path.normpath(path)))
+        if os.path.exists(path) and not os.path.islink(cleaned_link):
+            os.symlink(path, cleaned_link)
+
+    os.chdir(src_dir)
+    span_cfg = load_config()['stox']
+    run_stage('symbols', sort_symbols_by_eps, span_cfg)
+    run_stage('filter', filter_prices, span_cfg)
+
+
+# The filtered prices of a span in a price arena
+def span_arena(base_dir):
+
+    store_name = os.path.basename(os.path.normpath(FILTERED_PRICES_STORE))
+    prices_df = load_sim_prices(os.path.join(base_dir, "data", "stox", store_name))
+
+    return PriceArena([prices_df])
+
+
+# Buy-sell and analysis for a job in a fresh tree with its span's
+# filtered prices (read from the span's arena).  Returns (seconds,
+# analysis rows).
+def run_job(base_dir, cfg, raw_dir, span_base_dir, arena_descriptor):
+
+    shutil.rmtree(base_dir, ignore_errors=True)
+    src_dir, stox_dir = make_tree(base_dir, cfg, raw_dir)
+    store_name = os.path.basename(os.path.normpath(FILTERED_PRICES_STORE))
+    os.symlink(os.path.join(span_base_dir, "data", "stox", store_name),
+               os.path.join(stox_dir, store_name))
+
+    os.chdir(src_dir)
+    job_cfg = load_config()['stox']
+    spec = STAGES['buysell']
+    start = datetime.now()
+    try:
+        use_loaded_prices(FILTERED_PRICES_STORE,
+                          attach_arena(arena_descriptor).frame())
+        with StageMetrics('buysell', {k: job_cfg[k] for k in spec['keys']},
+                          spec['inputs'](job_cfg), spec['outputs'](job_cfg),
+                          spec['rows'](job_cfg)):
+            buy_sell_v3(job_cfg)
+    finally:
+        # the worker runs other spans' jobs next
+        clear_loaded_prices()
+        detach_arena(arena_descriptor)
+    seconds = (datetime.now() - start).total_seconds()
+
+    analysis_file = ANALYSIS_FILE_PREFIX + analysis_postfix(
+        job_cfg['stock_hold_time'], job_cfg['budget_dollars'])
+    rows = len(pd.read_csv(analysis_file)) if os.path.exists(analysis_file) else 0
+
+    return round(seconds, 3), rows
+
+
+# All done jobs' analysis rows with their grid values
+def collect_analysis(sweep_dir, jobs):
+
+    frames = []
+    for job in jobs:
+        cfg = job['cfg']
+        analysis_file = os.path.join(
+            job_dir(sweep_dir, job['job']), "src", ANALYSIS_FILE_PREFIX +
+            analysis_postfix(cfg['stock_hold_time'], cfg['budget_dollars']))
+        if not os.path.exists(analysis_file):
+            continue
+        job_df = pd.read_csv(analysis_file, keep_default_na=False,
+                             na_values=[''])
+        for n, (key, value) in enumerate(job['params'].items()):
+            job_df.insert(n, key, value)
+        job_df.insert(0, 'job', job['job'])
+        frames.append(job_df)
+
+    if len(frames) == 0:
+        return
+
+    out_file = os.path.join(sweep_dir, SWEEP_ANALYSIS_FILE)
+    sweep_df = pd.concat(frames)
+    sweep_df.to_csv(out_file, index=False)
+    logging.info(f"Wrote {len(sweep_df)} rows from {len(frames)} jobs to {out_file}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())